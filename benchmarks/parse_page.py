@@ -0,0 +1,180 @@
+# coding=utf-8
+""" Benchmark of `scihub.parse_page` against the previous implementation,
+    which used a separate XPath lookup for every field of an entry.
+
+    Usage: python benchmarks/parse_page.py [N_ENTRIES] [REPEAT]
+"""
+import re
+import sys
+import time
+import lxml.etree as ET
+from esahub import scihub, utils, geo
+
+
+# -----------------------------------------------------------------------------
+# PREVIOUS IMPLEMENTATION
+# -----------------------------------------------------------------------------
+def legacy_h2b(hstr, suffix='B'):
+    m = re.search(r'^[0-9\.]*', hstr)
+    num = float(m.group(0))
+    unit = hstr.replace(m.group(0), '').lstrip().upper()
+    for prefix in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
+        if unit == prefix + suffix:
+            return num
+        num *= 1024.0
+    return None
+
+
+def legacy_parse_page(xml):
+    PREFIXES = scihub.PREFIXES
+    file_list = []
+
+    try:
+        root = ET.fromstring(xml)
+
+        for entry in root.findall('doc:entry', PREFIXES):
+
+            filename = entry.find("./doc:str[@name='identifier']",
+                                  PREFIXES).text
+            ingestiondate = utils.to_date(
+                entry.find("./doc:date[@name='ingestiondate']", PREFIXES).text,
+                output='date')
+            try:
+                footprint_tag = entry.find("./doc:str[@name='gmlfootprint']",
+                                           PREFIXES).text
+                match = re.search('<gml:coordinates>(.*)</gml:coordinates>',
+                                  footprint_tag)
+                coords = geo.gml_to_polygon(match.groups()[0])
+            except AttributeError:
+                coords = None
+
+            filesize = legacy_h2b(entry.find("./doc:str[@name='size']",
+                                             PREFIXES).text)
+            preview_url = entry.find("./doc:link[@rel='icon']",
+                                     PREFIXES).attrib['href']
+            try:
+                rel_orbit = int(entry.find(
+                    "doc:int[@name='relativeorbitnumber']", PREFIXES).text)
+            except AttributeError:
+                rel_orbit = None
+
+            try:
+                orbit_dir = entry.find("doc:str[@name='orbitdirection']",
+                                       PREFIXES).text.upper()
+            except AttributeError:
+                orbit_dir = None
+
+            file_dict = {
+                'title': entry.find('doc:title', PREFIXES).text,
+                'url': entry.find('doc:link', PREFIXES).attrib['href'],
+                'preview': preview_url,
+                'uuid': entry.find('doc:id', PREFIXES).text,
+                'filename': filename,
+                'size': filesize,
+                'ingestiondate': ingestiondate,
+                'coords': coords,
+                'orbit_direction': orbit_dir,
+                'rel_orbit': rel_orbit
+            }
+            file_dict['host'] = scihub._get_host_from_url(file_dict['url'])
+            file_list.append(file_dict)
+
+    except ET.XMLSyntaxError:
+        # not valid XML
+        file_list = []
+
+    return file_list
+
+
+# -----------------------------------------------------------------------------
+# TEST DATA
+# -----------------------------------------------------------------------------
+FOOTPRINT = (
+    '&lt;gml:Polygon srsName="http://www.opengis.net/gml/srs/epsg.xml#4326" '
+    'xmlns:gml="http://www.opengis.net/gml"&gt;'
+    '&lt;gml:outerBoundaryIs&gt;&lt;gml:LinearRing&gt;'
+    '&lt;gml:coordinates&gt;{a},10.5 {a},12.5 {b},12.5 {b},10.5 {a},10.5'
+    '&lt;/gml:coordinates&gt;'
+    '&lt;/gml:LinearRing&gt;&lt;/gml:outerBoundaryIs&gt;&lt;/gml:Polygon&gt;'
+)
+
+ENTRY = """<entry>
+<title>{name}</title>
+<link href="{base}/$value"/>
+<link rel="alternative" href="{base}/"/>
+<link rel="icon" href="{base}/Products('Quicklook')/$value"/>
+<id>{uuid}</id>
+<summary>Instrument: SAR-C SAR, Satellite: Sentinel-1, Size: {size}</summary>
+<date name="ingestiondate">{ingestiondate}</date>
+<date name="beginposition">2018-01-{day:02d}T05:01:02.123Z</date>
+<int name="orbitnumber">{i}</int>
+<int name="relativeorbitnumber">{rel_orbit}</int>
+{footprint}
+<str name="size">{size}</str>
+<str name="orbitdirection">{direction}</str>
+<str name="identifier">{name}</str>
+<str name="uuid">{uuid}</str>
+</entry>"""
+
+
+def make_page(n, host='https://scihub.copernicus.eu/dhus'):
+    """Return a synthetic page of search results with `n` entries."""
+    entries = []
+    for i in range(n):
+        uuid = 'a5a8e2b4-{:04d}-4a43-8c34-9b2c1d0e{:04d}'.format(i % 9999, i)
+        name = 'S1A_IW_GRDH_1SDV_201801{:02d}T0{:05d}_{:06d}'.format(
+            i % 28 + 1, i, i)
+        if i % 5:
+            footprint = '<str name="gmlfootprint">{}</str>'.format(
+                FOOTPRINT.format(a=50 + i % 7, b=52 + i % 7))
+        else:
+            footprint = ''
+        if i % 4:
+            size = '{}.{} GB'.format(1 + i % 3, i % 10)
+        else:
+            size = '{} MB'.format(100 + i)
+        entries.append(ENTRY.format(
+            name=name, uuid=uuid, i=i, size=size, footprint=footprint,
+            base="{}/odata/v1/Products('{}')".format(host, uuid),
+            day=i % 28 + 1,
+            ingestiondate='2018-01-{:02d}T10:{:02d}:33.{:03d}Z'.format(
+                i % 28 + 1, i % 60, i % 1000),
+            rel_orbit=i % 175 + 1,
+            direction='ASCENDING' if i % 2 else 'DESCENDING'))
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" '
+        'xmlns="http://www.w3.org/2005/Atom">'
+        '<opensearch:totalResults>{}</opensearch:totalResults>'
+        '{}</feed>'.format(n, '\n'.join(entries))
+    ).encode('utf-8')
+
+
+# -----------------------------------------------------------------------------
+# BENCHMARK
+# -----------------------------------------------------------------------------
+def _time(fn, xml, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(xml)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(n=10000, repeat=5):
+    xml = make_page(n)
+    legacy_time, expected = _time(legacy_parse_page, xml, repeat)
+    new_time, result = _time(scihub.parse_page, xml, repeat)
+    if result != expected:
+        raise AssertionError('parse_page output differs from the previous '
+                             'implementation')
+    print('{} entries, best of {}'.format(n, repeat))
+    print('previous   {:8.3f}s'.format(legacy_time))
+    print('parse_page {:8.3f}s'.format(new_time))
+    print('speedup    {:8.2f}x'.format(legacy_time / new_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,334 @@
+# coding=utf-8
+""" This module contains a persistent on-disk cache of information retrieved
+    from the data hubs, shared by all processes of the same user.
+"""
+import os
+import re
+import time
+import pickle
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qsl, urlencode
+from .config import CONFIG
+
+
+CACHE_FILE = '~/.esahub_cache.sqlite'
+
+_STORES = {}
+_MD5_PATTERN = re.compile('^[0-9a-f]{32}$')
+_INGESTION_END = re.compile(r'ingestiondate:\[[^\]]*\bTO\s+([^\]\s]+)\s*\]')
+# Pagination parameters, which don't change the result of a query
+_PAGE_PARAMS = ('start', 'rows')
+
+
+def _identifier(name):
+    """Strip the directory and file extension from a product name."""
+    return os.path.splitext(os.path.split(name)[1])[0]
+
+
+def canonical_url(url):
+    """Return a canonical form of a query URL.
+
+    The parameters are sorted, repeated whitespace is collapsed and the
+    pagination parameters `start` and `rows` are removed, so that all URLs
+    that describe the same query have the same canonical form.
+
+    Parameters
+    ----------
+    url : str
+        The query URL.
+
+    Returns
+    -------
+    str
+        The canonical URL.
+    """
+    parsed = urlparse(url.strip())
+    params = sorted((key, ' '.join(value.split()))
+                    for key, value in parse_qsl(parsed.query,
+                                                keep_blank_values=True)
+                    if key not in _PAGE_PARAMS)
+    return parsed._replace(scheme=parsed.scheme.lower(),
+                           netloc=parsed.netloc.lower(),
+                           query=urlencode(params), fragment='').geturl()
+
+
+def _is_closed(url, settle=timedelta(days=1)):
+    """Whether the results of a query URL can no longer change.
+
+    This is the case if the query is restricted to an ingestion date range
+    that ended more than `settle` ago.
+    """
+    query = ' '.join(value for _, value in parse_qsl(urlparse(url).query))
+    ends = _INGESTION_END.findall(query)
+    if len(ends) == 0:
+        return False
+    before = datetime.now(timezone.utc) - settle
+    before = before.strftime('%Y-%m-%dT%H:%M:%S')
+    # The dates are in ISO format, so they can be compared as strings.
+    return all('NOW' not in end and end < before for end in ends)
+
+
+class ChecksumStore():
+    """
+    A SQLite database of remote md5 checksums.
+
+    The checksum of a product never changes, so the entries never expire.
+    Each entry can be looked up by the product uuid or identifier.
+
+    Parameters
+    ----------
+    path : str
+        The path of the database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            ' uuid TEXT PRIMARY KEY,'
+            ' identifier TEXT,'
+            ' md5 TEXT,'
+            ' created REAL)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS checksums_identifier '
+            'ON checksums (identifier)')
+
+    def close(self):
+        self._conn.close()
+
+    def get(self, uuid=None, identifier=None):
+        """Return the md5 checksum of a product, or None if unknown.
+
+        Parameters
+        ----------
+        uuid : str, optional
+            The product uuid. If given, `identifier` is ignored.
+        identifier : str, optional
+            The product identifier or file name.
+
+        Returns
+        -------
+        str or None
+            The md5 checksum in lower case.
+        """
+        if uuid is not None:
+            cursor = self._conn.execute(
+                'SELECT md5 FROM checksums WHERE uuid=?', (uuid,))
+        elif identifier is not None:
+            cursor = self._conn.execute(
+                'SELECT md5 FROM checksums WHERE identifier=?',
+                (_identifier(identifier),))
+        else:
+            return None
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def set(self, uuid, md5, identifier=None):
+        """Store the md5 checksum of a product.
+
+        Values that are not valid md5 checksums (e.g. error pages) are
+        ignored.
+
+        Parameters
+        ----------
+        uuid : str
+            The product uuid.
+        md5 : str
+            The md5 checksum.
+        identifier : str, optional
+            The product identifier or file name.
+
+        Returns
+        -------
+        bool
+            Whether the checksum was stored.
+        """
+        if uuid is None or not isinstance(md5, str):
+            return False
+        md5 = md5.strip().lower()
+        if not _MD5_PATTERN.match(md5):
+            return False
+        if identifier is not None:
+            identifier = _identifier(identifier)
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO checksums '
+                '(uuid, identifier, md5, created) VALUES (?, ?, ?, ?)',
+                (uuid, identifier, md5, time.time()))
+        return True
+
+
+class QueryCache():
+    """
+    A SQLite database of search results.
+
+    The results of each query are stored under the canonical form of the
+    query URL (see `canonical_url`). The results of queries that are
+    restricted to an ingestion date range in the past never expire; all
+    other results expire after `ttl` seconds. If the total size of the
+    cache exceeds `max_size`, the least recently used results are evicted.
+
+    Parameters
+    ----------
+    path : str
+        The path of the database file.
+    ttl : float, optional
+        The lifetime of the results of open-ended queries in seconds
+        (default: 600).
+    max_size : int, optional
+        The maximum total size of the stored results in bytes
+        (default: 100 MB).
+    """
+    def __init__(self, path, ttl=600.0, max_size=100 * 1024**2):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS queries ('
+            ' key TEXT PRIMARY KEY,'
+            ' results BLOB,'
+            ' size INTEGER,'
+            ' expires REAL,'
+            ' accessed REAL)')
+
+    def close(self):
+        self._conn.close()
+
+    def get(self, url):
+        """Return the cached results of a query, or None if not cached.
+
+        Parameters
+        ----------
+        url : str
+            The query URL.
+
+        Returns
+        -------
+        list of dict or None
+            The search results.
+        """
+        key = canonical_url(url)
+        now = time.time()
+        row = self._conn.execute(
+            'SELECT results, expires FROM queries WHERE key=?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        results, expires = row
+        with self._conn:
+            if expires is not None and expires < now:
+                self._conn.execute('DELETE FROM queries WHERE key=?', (key,))
+                return None
+            self._conn.execute('UPDATE queries SET accessed=? WHERE key=?',
+                               (now, key))
+        return pickle.loads(results)
+
+    def set(self, url, results):
+        """Store the results of a query.
+
+        Parameters
+        ----------
+        url : str
+            The query URL.
+        results : list of dict
+            The search results.
+        """
+        data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+        now = time.time()
+        expires = None if _is_closed(url) else now + self.ttl
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO queries '
+                '(key, results, size, expires, accessed) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (canonical_url(url), data, len(data), expires, now))
+            self._evict(now)
+
+    def _evict(self, now):
+        self._conn.execute(
+            'DELETE FROM queries WHERE expires IS NOT NULL AND expires < ?',
+            (now,))
+        total, = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM queries').fetchone()
+        if total <= self.max_size:
+            return
+        evict = []
+        for key, size in self._conn.execute(
+                'SELECT key, size FROM queries ORDER BY accessed'):
+            if total <= self.max_size:
+                break
+            evict.append((key,))
+            total -= size
+        self._conn.executemany('DELETE FROM queries WHERE key=?', evict)
+
+    def clear(self):
+        """Remove all cached results."""
+        with self._conn:
+            self._conn.execute('DELETE FROM queries')
+
+
+def _cache_path(path):
+    if path is None:
+        path = CONFIG['GENERAL'].get('CACHE_FILE') or CACHE_FILE
+    return os.path.expanduser(path)
+
+
+def _store(cls, path, **kwargs):
+    key = (cls, path)
+    if key in _STORES and not os.path.isfile(path):
+        # The database has been deleted in the meantime.
+        _STORES.pop(key).close()
+    if key not in _STORES:
+        _STORES[key] = cls(path, **kwargs)
+    return _STORES[key]
+
+
+def checksum_store(path=None):
+    """Return the checksum store.
+
+    Parameters
+    ----------
+    path : str, optional
+        The database file (default: CONFIG['GENERAL']['CACHE_FILE']).
+
+    Returns
+    -------
+    ChecksumStore or None
+        The checksum store, or None if disabled by
+        CONFIG['GENERAL']['CHECKSUM_CACHE'].
+    """
+    if not CONFIG['GENERAL'].get('CHECKSUM_CACHE', True):
+        return None
+    return _store(ChecksumStore, _cache_path(path))
+
+
+def query_cache(path=None):
+    """Return the query result cache.
+
+    Parameters
+    ----------
+    path : str, optional
+        The database file (default: CONFIG['GENERAL']['CACHE_FILE']).
+
+    Returns
+    -------
+    QueryCache or None
+        The query result cache, or None if disabled by
+        CONFIG['GENERAL']['QUERY_CACHE'].
+    """
+    if not CONFIG['GENERAL'].get('QUERY_CACHE', True):
+        return None
+    store = _store(QueryCache, _cache_path(path))
+    store.ttl = CONFIG['GENERAL'].get('QUERY_CACHE_TTL', 600.0)
+    store.max_size = CONFIG['GENERAL'].get('QUERY_CACHE_SIZE', 100) * 1024**2
+    return store
@@ -3,6 +3,7 @@
 import sys
 import binascii
 import hashlib
+import zipfile
 
 PY2 = sys.version_info < (3, 0)
 
@@ -19,11 +20,129 @@ def md5(filename):
     str
         The md5 checksum in lower case.
     """
+    return md5_hash(filename).hexdigest().lower()
+
+
+def md5_hash(filename, length=None, blocksize=1024**2):
+    """Compute the MD5 hash object of (the beginning of) a local file.
+
+    The file is read in blocks of bounded size, so that memory usage is
+    independent of the file size. The returned hash object can be updated
+    with further data.
+
+    Parameters
+    ----------
+    filename : str
+    length : int, optional
+        Only hash the first `length` bytes of the file. If None, hash the
+        entire file (default: None).
+    blocksize : int, optional
+        The number of bytes read at once (default: 1MB).
+
+    Returns
+    -------
+    hashlib.md5
+        The md5 hash object.
+    """
     hash_md5 = hashlib.md5()
+    remaining = length
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        while remaining is None or remaining > 0:
+            n = blocksize if remaining is None else min(blocksize, remaining)
+            chunk = f.read(n)
+            if not chunk:
+                break
             hash_md5.update(chunk)
-    return hash_md5.hexdigest().lower()
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hash_md5
+
+
+def verify(filename, compute_md5=True, check_zip=False):
+    """Verify a downloaded file.
+
+    This is a module level function so that it can be run in a process pool.
+
+    Parameters
+    ----------
+    filename : str
+    compute_md5 : bool, optional
+        Whether to compute the md5 hashsum (default: True).
+    check_zip : bool, optional
+        Whether to check that the file is a valid zip archive
+        (default: False).
+
+    Returns
+    -------
+    tuple (str, bool)
+        The md5 checksum in lower case (None if not computed) and whether the
+        file is a valid zip archive (True if not checked).
+    """
+    result_md5 = md5(filename) if compute_md5 else None
+    valid = True
+    if check_zip:
+        try:
+            zipfile.ZipFile(filename, 'r').close()
+        except zipfile.BadZipFile:
+            valid = False
+    return result_md5, valid
+
+
+class ETag():
+    """Compute the SWIFT/WOS etag of a byte stream incrementally.
+
+    The data is split into segments of `chunksize` MB, as in a multipart
+    upload, so the stream can be hashed while it is uploaded.
+
+    Parameters
+    ----------
+    chunksize : int
+        S3 chunksize in MB
+    system : str
+        One of 'swift' and 'wos'.
+    """
+    def __init__(self, chunksize, system='swift'):
+        if system.lower() not in ('swift', 'wos'):
+            raise ValueError("Invalid system: '{}'".format(system))
+        self.segment_size = chunksize * 1024**2
+        self.system = system.lower()
+        self._segment_md5s = []
+        self._md5 = hashlib.md5()
+        self._length = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            n = min(len(view), self.segment_size - self._length)
+            self._md5.update(view[:n])
+            self._length += n
+            view = view[n:]
+            if self._length == self.segment_size:
+                #
+                # Append the md5 of this segment and reset.
+                #
+                self._segment_md5s.append(self._md5.hexdigest())
+                self._md5 = hashlib.md5()
+                self._length = 0
+
+    def hexdigest(self):
+        segment_md5s = list(self._segment_md5s)
+        #
+        # If there is a 'remainder' left, append the md5.
+        #
+        if self._length > 0 or len(segment_md5s) == 0:
+            segment_md5s.append(self._md5.hexdigest())
+
+        if len(segment_md5s) == 1:
+            return segment_md5s[0].lower()
+
+        if self.system == 'swift':
+            return hashlib.md5(''.join(segment_md5s).encode('utf-8')) \
+                          .hexdigest().lower()
+        else:
+            return hashlib.md5(binascii.unhexlify(
+                                ''.join(segment_md5s).encode('utf-8'))) \
+                .hexdigest().lower() + '-{}'.format(len(segment_md5s))
 
 
 def etag(filename, chunksize, system='swift'):
@@ -47,44 +166,11 @@ def etag(filename, chunksize, system='swift'):
         The SWIFT/WOS etag in lower case.
     """
     oneMB = 1024**2
-    segment_md5s = []
-
+    hash_etag = ETag(chunksize, system=system)
     with open(filename, 'rb') as f:
         #
         # Read file in 1MB chunks to avoid memory issues
         #
-        chunk_counter = 0
-        md5 = hashlib.md5()
         for chunk in iter(lambda: f.read(oneMB), b""):
-            md5.update(chunk)
-            chunk_counter += 1
-            if chunk_counter % chunksize == 0:
-                #
-                # Append the md5 of this chunk and reset.
-                #
-                segment_md5s.append(md5.hexdigest())
-                md5 = hashlib.md5()
-        #
-        # If there is a 'remainder' left, append the md5.
-        #
-        if chunk_counter % chunksize != 0:
-            segment_md5s.append(md5.hexdigest())
-
-    if len(segment_md5s) == 1:
-        return segment_md5s[0].lower()
-
-    if system.lower() == 'swift':
-        if PY2:
-            return hashlib.md5(''.join(segment_md5s)).hexdigest().lower()
-        else:
-            return hashlib.md5(''.join(segment_md5s).encode('utf-8')) \
-                          .hexdigest().lower()
-    elif system.lower() == 'wos':
-        if PY2:
-            return hashlib.md5(binascii.unhexlify(
-                                ''.join(segment_md5s).encode('utf-8'))) \
-                .hexdigest().lower() + '-{}'.format(len(segment_md5s))
-        else:
-            return hashlib.md5(binascii.unhexlify(
-                                ''.join(segment_md5s).encode('utf-8'))) \
-                .hexdigest().lower() + '-{}'.format(len(segment_md5s))
+            hash_etag.update(chunk)
+    return hash_etag.hexdigest()
@@ -126,6 +126,20 @@ def parse_cli_options(args=None):
         p.add_argument(
             '--restart', action='store_true',
             help='Force restart of incomplete downloads (do not continue).')
+        p.add_argument(
+            '--resume', action='store_true',
+            help='Resume the unfinished downloads recorded in the journal\n'
+                 'of the data directory without searching.')
+        p.add_argument(
+            '--incremental', metavar='NAME',
+            help='Only search for products ingested since the last run\n'
+                 'of the query NAME.')
+        p.add_argument(
+            '--extract', action='store_true',
+            help='Extract the archives once they have been verified.')
+        p.add_argument(
+            '--drop-archive', action='store_true',
+            help='Delete the archives after extraction.')
 
     # ARGUMENTS FOR LS ONLY
     # -------------------------------------------------------------------------
@@ -203,6 +217,14 @@ def set_config(args):
         CONFIG['GENERAL']['OUT_FILE'] = args['out']
     if not_none(args, 'restart') and args['restart']:
         CONFIG['GENERAL']['CONTINUE'] = False
+    if not_none(args, 'resume') and args['resume']:
+        CONFIG['GENERAL']['RESUME'] = True
+    if not_none(args, 'incremental'):
+        CONFIG['GENERAL']['INCREMENTAL'] = args['incremental']
+    if not_none(args, 'extract') and args['extract']:
+        CONFIG['GENERAL']['EXTRACT'] = True
+    if not_none(args, 'drop_archive') and args['drop_archive']:
+        CONFIG['GENERAL']['KEEP_ARCHIVE'] = False
 
 
 # -----------------------------------------------------------------------------
@@ -240,9 +262,12 @@ def cli_main():
     #
     # These modules MUST be imported AFTER altering the CONFIG.
     #
-    from . import tty, main
+    from . import tty, main, scihub, metrics
+    metrics.start()
 
     def shutdown():
+        scihub.close_sessions()
+        metrics.stop()
         del tty.screen
 
     def interrupt():
@@ -259,7 +284,7 @@ def cli_main():
             main.doctor(delete=args['delete'], repair=args['repair'])
 
         elif cmd == 'ls':
-            main.ls()
+            main.ls(return_list=False)
 
         elif cmd == 'get':
             main.get()
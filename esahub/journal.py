@@ -0,0 +1,267 @@
+# coding=utf-8
+""" This module keeps a persistent journal of the state of all downloads in a
+    data directory, so that an interrupted batch can be resumed without
+    searching or rehashing files that have already been verified.
+"""
+import os
+import json
+import time
+import sqlite3
+from datetime import datetime, timezone
+from .config import CONFIG
+
+
+JOURNAL_FILE = '.esahub_journal.sqlite'
+QUEUED = 'queued'
+PARTIAL = 'partial'
+DOWNLOADED = 'downloaded'
+VERIFIED = 'verified'
+FAILED = 'failed'
+# The format of the stored high-water marks (always UTC)
+MARK_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+_JOURNALS = {}
+
+
+def _unchanged(entry, path):
+    """Check whether a file still has the size and modification time
+    recorded in a journal entry."""
+    if not os.path.isfile(path):
+        return False
+    stat = os.stat(path)
+    return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+
+class Journal():
+    """
+    A SQLite database recording the download state of each product.
+
+    The states are
+    - 'queued' : the product is scheduled for download
+    - 'partial' : the download was interrupted at `offset` bytes
+    - 'downloaded' : the download is complete but not yet verified
+    - 'verified' : the local file matches the remote checksum
+    - 'failed' : all download trials failed
+
+    Each product remembers the run (i.e. the process) that queued it last.
+
+    It also records the high-water mark of each named incremental query,
+    i.e. the latest ingestion date of the products it has downloaded.
+
+    Parameters
+    ----------
+    path : str
+        The path of the database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.run = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS products ('
+            ' filename TEXT PRIMARY KEY,'
+            ' product TEXT,'
+            ' state TEXT,'
+            ' offset INTEGER,'
+            ' md5 TEXT,'
+            ' size INTEGER,'
+            ' mtime REAL,'
+            ' updated REAL,'
+            ' run REAL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS queries ('
+            ' name TEXT PRIMARY KEY,'
+            ' ingestiondate TEXT,'
+            ' updated REAL)')
+
+    def close(self):
+        self._conn.close()
+
+    def queue(self, products):
+        """Record a list of products as queued.
+
+        Products that have already been verified keep their state.
+
+        Parameters
+        ----------
+        products : list of dict
+            The search results to be downloaded.
+        """
+        now = time.time()
+        products = [p for p in products if type(p) is dict]
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO products (filename) VALUES (?)',
+                [(p['filename'],) for p in products])
+            self._conn.executemany(
+                'UPDATE products SET product=?, updated=?, run=?, '
+                ' state=CASE WHEN state=? THEN state ELSE ? END '
+                'WHERE filename=?',
+                [(json.dumps(p, default=str), now, self.run, VERIFIED,
+                  QUEUED, p['filename']) for p in products])
+
+    def update(self, filename, state, offset=None, md5=None, path=None):
+        """Set the state of a product.
+
+        Parameters
+        ----------
+        filename : str
+            The product identifier.
+        state : str
+            The new state.
+        offset : int, optional
+            The number of bytes downloaded so far.
+        md5 : str, optional
+            The verified md5 checksum.
+        path : str, optional
+            The local file. If given, its size and modification time are
+            stored, so that later runs can detect whether it has changed.
+        """
+        size = mtime = None
+        if path is not None and os.path.isfile(path):
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO products (filename) VALUES (?)',
+                (filename,))
+            self._conn.execute(
+                'UPDATE products SET state=?, offset=?, md5=?, size=?, '
+                ' mtime=?, updated=? '
+                'WHERE filename=?',
+                (state, offset, md5, size, mtime, time.time(), filename))
+
+    def get(self, filename):
+        """Return the journal entry of a product as dict, or None."""
+        cursor = self._conn.execute(
+            'SELECT filename, product, state, offset, md5, size, mtime '
+            'FROM products WHERE filename=?', (filename,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        keys = ('filename', 'product', 'state', 'offset', 'md5', 'size',
+                'mtime')
+        entry = dict(zip(keys, row))
+        if entry['product'] is not None:
+            entry['product'] = json.loads(entry['product'])
+        return entry
+
+    def is_verified(self, filename, path):
+        """Check whether a local file has been verified and not changed
+        since.
+
+        Returns
+        -------
+        str or None
+            The verified md5 checksum, or None.
+        """
+        entry = self.get(filename)
+        if entry is None or entry['state'] != VERIFIED or \
+                not _unchanged(entry, path):
+            return None
+        return entry['md5']
+
+    def is_downloaded(self, filename, path):
+        """Check whether the transfer of a product has been completed, but
+        the file has not been verified yet, and not changed since.
+
+        Returns
+        -------
+        bool
+        """
+        entry = self.get(filename)
+        return entry is not None and entry['state'] == DOWNLOADED and \
+            _unchanged(entry, path)
+
+    def pending(self):
+        """Return the products of the last run that have not been verified
+        yet. Products left over from earlier runs are not returned.
+
+        Returns
+        -------
+        list of dict
+            The search results of the pending products.
+        """
+        cursor = self._conn.execute(
+            'SELECT product FROM products '
+            'WHERE state != ? AND product IS NOT NULL '
+            ' AND run = (SELECT MAX(run) FROM products) '
+            'ORDER BY rowid', (VERIFIED,))
+        return [json.loads(row[0]) for row in cursor]
+
+    def high_water_mark(self, name):
+        """Return the high-water mark of a named query.
+
+        Parameters
+        ----------
+        name : str
+            The query name.
+
+        Returns
+        -------
+        datetime.datetime or None
+            The latest ingestion date recorded for the query (in UTC), or
+            None if the query has not been run before.
+        """
+        row = self._conn.execute(
+            'SELECT ingestiondate FROM queries WHERE name=?',
+            (name,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return datetime.strptime(row[0], MARK_FMT).replace(
+            tzinfo=timezone.utc)
+
+    def advance(self, name, ingestiondate):
+        """Raise the high-water mark of a named query.
+
+        The mark is never lowered.
+
+        Parameters
+        ----------
+        name : str
+            The query name.
+        ingestiondate : datetime.datetime
+            The latest ingestion date of the downloaded products. Naive
+            dates are assumed to be in UTC.
+        """
+        if ingestiondate.tzinfo is None:
+            ingestiondate = ingestiondate.replace(tzinfo=timezone.utc)
+        mark = ingestiondate.astimezone(timezone.utc).strftime(MARK_FMT)
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO queries (name) VALUES (?)', (name,))
+            # The format sorts chronologically.
+            self._conn.execute(
+                'UPDATE queries SET ingestiondate=?, updated=? '
+                'WHERE name=? AND '
+                ' (ingestiondate IS NULL OR ingestiondate < ?)',
+                (mark, time.time(), name, mark))
+
+
+def open_journal(directory=None):
+    """Return the journal of a data directory.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The data directory (default: CONFIG['GENERAL']['DATA_DIR']).
+
+    Returns
+    -------
+    Journal or None
+        The journal, or None if disabled by CONFIG['GENERAL']['JOURNAL'].
+    """
+    if not CONFIG['GENERAL'].get('JOURNAL', True):
+        return None
+    if directory is None:
+        directory = CONFIG['GENERAL']['DATA_DIR']
+    path = os.path.join(directory, JOURNAL_FILE)
+    if path in _JOURNALS and not os.path.isfile(path):
+        # The database has been deleted in the meantime.
+        _JOURNALS.pop(path).close()
+    if path not in _JOURNALS:
+        _JOURNALS[path] = Journal(path)
+    return _JOURNALS[path]
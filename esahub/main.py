@@ -8,8 +8,9 @@ import sys
 import os
 import json
 import asyncio
+from datetime import timedelta
 from .config import CONFIG
-from . import scihub, check, tty, utils
+from . import scihub, check, tty, utils, journal
 
 logger = logging.getLogger('esahub')
 PY2 = sys.version_info < (3, 0)
@@ -25,11 +26,108 @@ def list_local_archives():
     return utils.ls(CONFIG['GENERAL']['DATA_DIR'])
 
 
+async def _announce(products, found=None):
+    """Pass on the products of a search while updating the status bar.
+
+    If `found` is given, each product is appended to it.
+    """
+    count = 0
+    size = 0
+    async for product in products:
+        count += 1
+        size += product['size']
+        if found is not None:
+            found.append(product)
+        tty.screen.status(
+            desc='Downloading {0:d} files ({1}) into {2} ...'.format(
+                count, utils.b2h(size), CONFIG['GENERAL']['DATA_DIR']),
+            total=size)
+        yield product
+    logging.info('Downloading {0:d} files ({1}) into {2} ...'.format(
+        count, utils.b2h(size), CONFIG['GENERAL']['DATA_DIR']))
+
+
+def _since_high_water_mark(query, name):
+    """Restrict a query to the products ingested since the last run of the
+    named incremental query, minus CONFIG['GENERAL']['INCREMENTAL_OVERLAP']
+    seconds.
+
+    The results are sorted by ingestion date in ascending order, so that a
+    limit leaves out the latest products rather than arbitrary ones. The
+    query is modified in place.
+    """
+    query['sort'] = ('ingestiondate', 'asc')
+    jrnl = journal.open_journal()
+    if jrnl is None:
+        logger.warning('Incremental queries require the journal. '
+                       'Searching all products.')
+        return
+    since = jrnl.high_water_mark(name)
+    if since is None:
+        logger.info("First run of incremental query '{}'".format(name))
+        return
+    since -= timedelta(
+        seconds=CONFIG['GENERAL'].get('INCREMENTAL_OVERLAP', 3600))
+    start, end = scihub._parse_time_parameter(query.get('time', (None, None)))
+    since = scihub._format_time(since)
+    # Both are formatted as ISO dates, so they can be compared as strings.
+    query['time'] = (max(start, since), end)
+    logger.info("Incremental query '{}' since {}".format(name, since))
+
+
+def _advance_high_water_mark(name, products, results, limit=None):
+    """Advance the high-water mark of a named query to the latest ingestion
+    date of the downloaded products.
+
+    Products ingested after the first failed download are not taken into
+    account, so that the next run searches for the failed product again.
+    Skipped downloads (None) don't hold back the high-water mark.
+
+    If the search was cut off at `limit` products, each server may have
+    more products ingested after the last one it returned. The mark is
+    then not advanced beyond the earliest of these dates.
+    """
+    jrnl = journal.open_journal()
+    if jrnl is None:
+        return
+    succeeded = []
+    failed = []
+    latest = {}
+    for product, result in zip(products, results):
+        date = product.get('ingestiondate')
+        if date is None:
+            continue
+        host = scihub._get_host_from_url(product['url'])
+        latest[host] = max(latest.get(host, date), date)
+        if isinstance(result, tuple):
+            result = result[0]
+        (failed if result is False else succeeded).append(date)
+    if limit is not None and len(products) >= limit and latest:
+        # Search again from the earliest date a server may have more
+        # products for.
+        failed.append(min(latest.values()))
+    if failed:
+        succeeded = [date for date in succeeded if date < min(failed)]
+    if succeeded:
+        jrnl.advance(name, max(succeeded))
+
+
 # -----------------------------------------------------------------------------
 # MAIN COMMANDS
 # -----------------------------------------------------------------------------
 def query_file_list(query=None, limit=None):
-    if 'IN_FILE' in CONFIG['GENERAL'] and \
+    if CONFIG['GENERAL'].get('RESUME'):
+        #
+        # Continue the downloads recorded in the journal without searching.
+        #
+        jrnl = journal.open_journal()
+        if jrnl is None:
+            raise ValueError('Cannot resume downloads without a journal '
+                             '(CONFIG.GENERAL.JOURNAL is disabled).')
+        file_list = jrnl.pending()
+        if limit is not None:
+            file_list = file_list[:limit]
+    elif 'IN_FILE' in CONFIG['GENERAL'] and \
             CONFIG['GENERAL']['IN_FILE'] is not None:
         with open(CONFIG['GENERAL']['IN_FILE'], 'r') as f:
             file_list = json.load(f)
@@ -55,6 +153,25 @@ def get(query=None, limit=None):
     limit : int, optional
         The maximum number of files to download.
     """
+    if not CONFIG['GENERAL'].get('RESUME') and \
+            CONFIG['GENERAL'].get('IN_FILE') is None:
+        #
+        # Start downloading while the search is still running.
+        #
+        if query is None:
+            query = CONFIG['GENERAL']['QUERY']
+        name = CONFIG['GENERAL'].get('INCREMENTAL')
+        if name:
+            _since_high_water_mark(query, name)
+        found = []
+        tty.screen.status(desc='Searching ...', mode='bar', reset=True,
+                          unit='B', scale=True)
+        results = scihub.download(_announce(
+            scihub._iter_search(query, limit=limit, verbose=True), found))
+        if name:
+            _advance_high_water_mark(name, found, results, limit=limit)
+        return
+
     file_list = query_file_list(query, limit=limit)
     size = sum(f['size'] for f in file_list)
 
@@ -70,7 +187,7 @@ def get(query=None, limit=None):
     scihub.download(file_list)
 
 
-def ls(query=None, quiet=False):
+def ls(query=None, quiet=False, return_list=True):
     """List and count files matching the query and compute total file size.
 
     Parameters
@@ -79,34 +196,44 @@ def ls(query=None, quiet=False):
         (default: None)
     quiet : bool, optional
         Whether to suppress console output.
+    return_list : bool, optional
+        Whether to return the search results. Otherwise, the results are
+        only kept in memory if they are written to CONFIG.GENERAL.OUT_FILE
+        (default: True).
+
+    Returns
+    -------
+    list of dict or int
+        The search results, or their number if `return_list` is False.
     """
     tty.screen.status('Searching ...', mode='static')
     if query is None:
         query = CONFIG['GENERAL']['QUERY']
-    file_list = scihub.search(query, verbose=True)
+    out_file = CONFIG['GENERAL'].get('OUT_FILE')
+    file_list = [] if return_list or out_file is not None else None
+    count = 0
     size = 0.0
-    for f in file_list:
+    for f in scihub.iter_search(query, verbose=True):
+        if file_list is not None:
+            file_list.append(f)
+        count += 1
         size += f['size']
+        if not quiet:
+            logging.info(f['filename'])
     if not quiet:
-        msg = 'Found {0:d} files ({1}).'.format(len(file_list),
-                                                utils.b2h(size))
+        msg = 'Found {0:d} files ({1}).'.format(count, utils.b2h(size))
         logging.info(msg)
         tty.screen.result(msg)
-        for f in file_list:
-            msg = '{:>8} {}'.format(utils.b2h(f['size']), f['filename'])
-            # tty.update(f['filename'],msg)
-            logging.info(f['filename'])
 
     #
     # Write file_list to JSON file
     # so it can be read later by the get() and store() commands.
     #
-    if 'OUT_FILE' in CONFIG['GENERAL'] and \
-            CONFIG['GENERAL']['OUT_FILE'] is not None:
-        with open(CONFIG['GENERAL']['OUT_FILE'], 'w') as f:
+    if out_file is not None:
+        with open(out_file, 'w') as f:
             json.dump(file_list, f, default=str, indent=2)
 
-    return file_list
+    return file_list if return_list else count
 
 
 def doctor(delete=False, repair=False):
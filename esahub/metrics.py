@@ -0,0 +1,327 @@
+# coding=utf-8
+""" This module collects metrics about the transfers and exports them in the
+    Prometheus text format, either to a file (for the node exporter textfile
+    collector) or via a local HTTP endpoint.
+"""
+import os
+import time
+import math
+import bisect
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from .config import CONFIG
+
+logger = logging.getLogger('esahub')
+
+_LOCK = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+                     .replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric():
+    """
+    Base class of all metrics.
+
+    Parameters
+    ----------
+    name : str
+        The metric name.
+    documentation : str
+        The help text.
+    labels : tuple of str, optional
+        The label names.
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} requires the labels {}'.format(
+                self.name, self.labels))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for suffix, key, extra, value in self._samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _format_labels(self.labels, key, extra),
+                _format_value(value)))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with _LOCK:
+            self._values = {}
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. the number of bytes received."""
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _LOCK:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [('_total', key, (), value)
+                for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the number of active
+    connections."""
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _LOCK:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _LOCK:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [('', key, (), value)
+                for key, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values, e.g. request latencies.
+
+    Parameters
+    ----------
+    buckets : tuple of float, optional
+        The upper bounds of the buckets in increasing order.
+    """
+    TYPE = 'histogram'
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+               300.0, 1800.0)
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(name, documentation, labels=labels)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _LOCK:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """Return a context manager that observes the duration of its
+        block."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        samples = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append(('_bucket', key,
+                                (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.monotonic() - self._start,
+                                **self._labels)
+
+
+class Registry():
+    """A collection of metrics."""
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def expose(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with _LOCK:
+            return '\n'.join(m.expose() for m in self._metrics) + '\n'
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+# -----------------------------------------------------------------------------
+# METRICS
+# -----------------------------------------------------------------------------
+BYTES = Counter(
+    'esahub_download_bytes', 'Bytes received from each server.',
+    labels=('server',))
+THROUGHPUT = Gauge(
+    'esahub_download_throughput_bytes_per_second',
+    'Most recently measured download throughput of each server.',
+    labels=('server',))
+ACTIVE = Gauge(
+    'esahub_active_downloads',
+    'Number of download connections currently receiving data.',
+    labels=('server',))
+RETRIES = Counter(
+    'esahub_retries', 'Number of retried downloads.', labels=('server',))
+BUSY = Counter(
+    'esahub_server_busy_responses',
+    'Number of HTTP 503/429 responses of each server.',
+    labels=('server', 'status'))
+CHECKSUM_FAILURES = Counter(
+    'esahub_checksum_failures',
+    'Number of downloads that failed the MD5 check.', labels=('server',))
+LATENCY = Histogram(
+    'esahub_request_duration_seconds',
+    'Duration of requests to the servers.',
+    labels=('operation', 'server'))
+
+
+# -----------------------------------------------------------------------------
+# EXPORT
+# -----------------------------------------------------------------------------
+def write_textfile(path=None):
+    """Write all metrics to a file for the node exporter textfile collector.
+
+    The file is replaced atomically.
+
+    Parameters
+    ----------
+    path : str, optional
+        The output file (default: CONFIG['GENERAL']['METRICS_FILE']).
+    """
+    if path is None:
+        path = CONFIG['GENERAL'].get('METRICS_FILE')
+    if not path:
+        return
+    path = os.path.expanduser(path)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(REGISTRY.expose())
+    os.replace(tmp_path, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_SERVER = None
+_WRITER = None
+
+
+def start(port=None, path=None, interval=None):
+    """Start exporting the metrics in background threads.
+
+    Parameters
+    ----------
+    port : int, optional
+        Serve the metrics via HTTP on this local port
+        (default: CONFIG['GENERAL']['METRICS_PORT']).
+    path : str, optional
+        Write the metrics to this file regularly
+        (default: CONFIG['GENERAL']['METRICS_FILE']).
+    interval : float, optional
+        The number of seconds between writes of the file
+        (default: CONFIG['GENERAL']['METRICS_INTERVAL']).
+    """
+    global _SERVER, _WRITER
+    if port is None:
+        port = CONFIG['GENERAL'].get('METRICS_PORT')
+    if path is None:
+        path = CONFIG['GENERAL'].get('METRICS_FILE')
+    if interval is None:
+        interval = CONFIG['GENERAL'].get('METRICS_INTERVAL', 15.0)
+
+    if port and _SERVER is None:
+        _SERVER = HTTPServer(('127.0.0.1', int(port)), _Handler)
+        threading.Thread(target=_SERVER.serve_forever, daemon=True).start()
+        logger.info('Serving metrics on port {}'.format(port))
+
+    if path and _WRITER is None:
+        _WRITER = threading.Event()
+
+        def _write():
+            while not _WRITER.wait(interval):
+                try:
+                    write_textfile(path)
+                except OSError as e:
+                    logger.warning('Could not write metrics: {}'.format(e))
+
+        threading.Thread(target=_write, daemon=True).start()
+
+
+def stop():
+    """Stop the exporters and write the metrics file a final time."""
+    global _SERVER, _WRITER
+    if _SERVER is not None:
+        _SERVER.shutdown()
+        _SERVER.server_close()
+        _SERVER = None
+    if _WRITER is not None:
+        _WRITER.set()
+        _WRITER = None
+    write_textfile()
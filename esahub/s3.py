@@ -0,0 +1,196 @@
+# coding=utf-8
+""" This module contains methods to stream downloads directly into S3
+    compatible object storage, without staging them on the local disk.
+"""
+import asyncio
+import functools
+import logging
+from .config import CONFIG
+from . import checksum
+try:
+    import boto3
+    BOTO3_INSTALLED = True
+except ImportError:
+    BOTO3_INSTALLED = False
+
+logger = logging.getLogger('esahub')
+
+
+class ETagMismatchError(Exception):
+    pass
+
+
+def get_client():
+    """Create an S3 client.
+
+    The credentials are taken from the usual boto3 configuration, the
+    endpoint from `CONFIG['GENERAL']['S3_ENDPOINT']` (leave empty for AWS).
+    """
+    if not BOTO3_INSTALLED:
+        raise ImportError("`boto3` must be installed to use this feature!")
+    return boto3.client(
+        's3', endpoint_url=CONFIG['GENERAL'].get('S3_ENDPOINT') or None)
+
+
+class S3Writer():
+    """
+    Upload a byte stream to S3 as a multipart upload.
+
+    This has the same interface as `scihub.StreamWriter`. Parts of
+    `part_size` MB are uploaded in the background while the stream is still
+    being received, and the etag is computed on the fly. The object is only
+    created once `complete()` is called; `abort()` discards all uploaded
+    parts.
+
+    Parameters
+    ----------
+    bucket : str
+        The target bucket.
+    key : str
+        The target object key.
+    client : botocore.client.S3, optional
+        The S3 client (default: `get_client()`).
+    part_size : int, optional
+        The part size in MB (default: CONFIG['GENERAL']['S3_PART_SIZE']).
+        Must be at least 5.
+    system : str, optional
+        The etag scheme of the object store, one of 'swift' and 'wos'
+        (default: CONFIG['GENERAL']['S3_ETAG_SYSTEM']). 'wos' is the scheme
+        used by AWS S3.
+    hash_md5 : hashlib.md5, optional
+        If given, the hash object is updated with all data written.
+    max_pending : int, optional
+        The maximum number of parts being uploaded at the same time
+        (default: 2).
+    """
+    def __init__(self, bucket, key, client=None, part_size=None, system=None,
+                 hash_md5=None, max_pending=2):
+        if client is None:
+            client = get_client()
+        if part_size is None:
+            part_size = CONFIG['GENERAL'].get('S3_PART_SIZE', 64)
+        if system is None:
+            system = CONFIG['GENERAL'].get('S3_ETAG_SYSTEM', 'wos')
+        self.bucket = bucket
+        self.key = key
+        self.written = 0
+        self._client = client
+        self._part_size = part_size * 1024**2
+        self._etag = checksum.ETag(part_size, system=system)
+        self._hash = hash_md5
+        self._buffer = bytearray()
+        self._hashed = False
+        self._upload_id = None
+        self._parts = []
+        self._pending = []
+        self._max_pending = max_pending
+
+    async def _call(self, method, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(getattr(self._client, method), **kwargs))
+
+    def _update_hash(self, data):
+        self._etag.update(data)
+        if self._hash is not None:
+            self._hash.update(data)
+
+    async def _upload_part(self, data):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._update_hash, data)
+        if self._upload_id is None:
+            response = await self._call('create_multipart_upload',
+                                        Bucket=self.bucket, Key=self.key)
+            self._upload_id = response['UploadId']
+        part_number = len(self._parts) + 1
+        self._parts.append(None)
+        self._pending.append(asyncio.ensure_future(self._call(
+            'upload_part', Bucket=self.bucket, Key=self.key,
+            UploadId=self._upload_id, PartNumber=part_number, Body=data)))
+        if len(self._pending) >= self._max_pending:
+            await self._wait(self._pending.pop(0))
+
+    async def _wait(self, future):
+        response = await future
+        index = self._parts.index(None)
+        self._parts[index] = {'PartNumber': index + 1,
+                              'ETag': response['ETag']}
+
+    async def write(self, data):
+        self._buffer.extend(data)
+        self.written += len(data)
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[:self._part_size])
+            del self._buffer[:self._part_size]
+            await self._upload_part(part)
+
+    async def close(self):
+        """Wait for all parts to be uploaded. The remaining data is hashed
+        and uploaded by `complete()`."""
+        if not self._hashed:
+            self._update_hash(self._buffer)
+            self._hashed = True
+        while self._pending:
+            await self._wait(self._pending.pop(0))
+
+    def etag(self):
+        """Return the etag of all data written."""
+        return self._etag.hexdigest()
+
+    async def complete(self):
+        """Create the object and verify its etag.
+
+        Returns
+        -------
+        str
+            The etag of the object.
+
+        Raises
+        ------
+        ETagMismatchError
+            If the etag reported by the object store does not match the
+            etag of the data. The object is deleted in that case.
+        """
+        await self.close()
+        data = bytes(self._buffer)
+        if self._upload_id is None:
+            await self._call('put_object', Bucket=self.bucket, Key=self.key,
+                             Body=data)
+        else:
+            if len(data) > 0:
+                self._parts.append(None)
+                await self._wait(self._call(
+                    'upload_part', Bucket=self.bucket, Key=self.key,
+                    UploadId=self._upload_id, PartNumber=len(self._parts),
+                    Body=data))
+            await self._call('complete_multipart_upload',
+                             Bucket=self.bucket, Key=self.key,
+                             UploadId=self._upload_id,
+                             MultipartUpload={'Parts': self._parts})
+        self._buffer = bytearray()
+
+        response = await self._call('head_object', Bucket=self.bucket,
+                                    Key=self.key)
+        remote_etag = response['ETag'].strip('"').lower()
+        if remote_etag != self.etag():
+            await self._call('delete_object', Bucket=self.bucket,
+                             Key=self.key)
+            raise ETagMismatchError(
+                's3://{}/{}: etag {} does not match {}'.format(
+                    self.bucket, self.key, remote_etag, self.etag()))
+        return remote_etag
+
+    async def abort(self):
+        """Discard the upload."""
+        for future in self._pending:
+            future.cancel()
+        self._pending = []
+        if self._upload_id is not None:
+            try:
+                await self._call('abort_multipart_upload',
+                                 Bucket=self.bucket, Key=self.key,
+                                 UploadId=self._upload_id)
+            except Exception as e:
+                logger.warning('Could not abort upload of s3://{}/{}: {}'
+                               .format(self.bucket, self.key, e))
+            self._upload_id = None
@@ -4,17 +4,31 @@ import asyncio
 import lxml.etree as ET
 from datetime import datetime, timedelta
 import pytz
+from dateutil.tz import tzutc
 import re
 from .config import CONFIG
-from . import utils, geo, checksum, tty
+from . import utils, geo, checksum, tty, throttle, journal, cache, s3, \
+    metrics
 from urllib.parse import urlparse, parse_qs, urlencode
 from collections import OrderedDict
+import collections
+import itertools
+import heapq
+import shutil
+import concurrent.futures
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import hashlib
+import json
+import io
 import logging
 logger = logging.getLogger('esahub')
 logger.disabled = True
 
 
+# Default chunk size, overridden by CONFIG['GENERAL']['CHUNK_SIZE'] (in KB)
 CHUNK = 64 * 1024
 PREFIXES = {
     'os': 'http://a9.com/-/spec/opensearch/1.1/',
@@ -23,6 +37,10 @@ PREFIXES = {
     'gml': 'http://www.opengis.net/gml'
 }
 DOWNLOAD_SUFFIX = '.download'
+PROGRESS_SUFFIX = '.progress'
+LOCK_SUFFIX = '.lock'
+# Number of bytes after which the progress of a download is saved.
+PROGRESS_INTERVAL = 16 * 1024**2
 DOWNLOAD_URL_PATTERN = \
     "{host}/odata/v1/Products('{uuid}')/$value"
 CHECKSUM_URL_PATTERN = \
@@ -40,43 +58,128 @@ class NotFoundError(Exception):
     pass
 
 
+class ServerBusyError(Exception):
+    """Raised when a server responds with HTTP 503 or 429."""
+    pass
+
+
+class ServerUnavailableError(Exception):
+    """Raised when the circuit breaker of a server is open."""
+    pass
+
+
 class SessionManager():
     """
     Manage active HTTP sessions.
 
     Keep different sessions for queries and downloads, because concurrent
     downloads are limited, while queries are not.
+
+    A manager has one session per server, whose connections are kept alive
+    and reused by all requests made through that manager. The managers don't
+    share connections: searches and checksums (`QUERY`), downloads
+    (`DOWNLOAD`) and previews (`PREVIEW`) each have their own connection
+    pool, so that they never wait for each other.
+
+    A session is created on first use and recreated if it has been closed.
+    Each event loop gets its own sessions. The sessions of the current loop
+    should be closed with `close()`, or by using the manager as an async
+    context manager. `close_idle()` closes the sessions of loops that are
+    not running, e.g. those of earlier `block()` calls on other loops.
+
+    Parameters
+    ----------
+    concurrent : int, optional
+        The maximum number of connections per server (default: the
+        `downloads` of the server).
     """
     def __init__(self, concurrent=None):
         self._concurrent = concurrent
         self._sessions = {}
 
+    def _create_session(self, server):
+        cfg = CONFIG['SERVERS'][server]
+        auth = aiohttp.BasicAuth(login=cfg['user'],
+                                 password=cfg['password'])
+        if self._concurrent is None:
+            concurrent = cfg['downloads']
+        else:
+            concurrent = self._concurrent
+        connector = aiohttp.TCPConnector(
+            limit=concurrent, limit_per_host=concurrent,
+            ttl_dns_cache=CONFIG['GENERAL'].get('DNS_CACHE', 300),
+            keepalive_timeout=CONFIG['GENERAL'].get('KEEPALIVE', 60.0))
+        return aiohttp.ClientSession(auth=auth, connector=connector)
+
     def __getitem__(self, server):
-        if server not in self._sessions:
-            cfg = CONFIG['SERVERS'][server]
-            auth = aiohttp.BasicAuth(login=cfg['user'],
-                                     password=cfg['password'])
-            if self._concurrent is None:
-                concurrent = cfg['downloads']
-            else:
-                concurrent = self._concurrent
-            connector = aiohttp.TCPConnector(limit=concurrent)
-            self._sessions[server] = aiohttp.ClientSession(
-                auth=auth, connector=connector)
-        return self._sessions[server]
+        loop = asyncio.get_event_loop()
+        # The sessions of closed loops cannot be closed anymore.
+        for key in [key for key in self._sessions if key[1].is_closed()]:
+            del self._sessions[key]
+        key = (server, loop)
+        if key in self._sessions and self._sessions[key].closed:
+            del self._sessions[key]
+        if key not in self._sessions:
+            self._sessions[key] = self._create_session(server)
+        return self._sessions[key]
+
+    async def close(self):
+        """Close all sessions that belong to the current event loop."""
+        loop = asyncio.get_event_loop()
+        for key in [key for key in self._sessions if key[1] is loop]:
+            session = self._sessions.pop(key)
+            if not session.closed:
+                await session.close()
+
+    def close_idle(self):
+        """Close all sessions whose event loop is not running."""
+        for key in list(self._sessions):
+            loop = key[1]
+            if loop.is_running():
+                continue
+            session = self._sessions.pop(key)
+            if not session.closed and not loop.is_closed():
+                loop.run_until_complete(session.close())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     def __del__(self):
-        # Close all active sessions
-        loop = asyncio.get_event_loop()
-        closer_tasks = []
-        for server, session in self._sessions.items():
-            closer_tasks.append(session.close())
-        if len(closer_tasks) > 0:
-            loop.run_until_complete(asyncio.wait(closer_tasks))
+        # Best effort: close the sessions if their event loop is idle.
+        try:
+            self.close_idle()
+        except Exception:
+            pass
 
 
 QUERY = SessionManager(concurrent=CONFIG['GENERAL']['N_SCIHUB_QUERIES'])
 DOWNLOAD = SessionManager()
+# Preview images are fetched with a small separate connection pool, so they
+# never compete with the product downloads.
+PREVIEW = SessionManager(concurrent=CONFIG['GENERAL'].get('N_PREVIEWS', 4))
+BANDWIDTH = throttle.BandwidthLimiter()
+LIMITS = throttle.AdaptiveLimits()
+BREAKERS = throttle.CircuitBreakers()
+
+
+async def _close_sessions():
+    for manager in (QUERY, DOWNLOAD, PREVIEW):
+        await manager.close()
+
+
+def close_sessions():
+    """Close all HTTP sessions and shut down the verification processes,
+    e.g. before the program exits.
+
+    New sessions and processes are created automatically when needed.
+    """
+    block(_close_sessions)
+    for manager in (QUERY, DOWNLOAD, PREVIEW):
+        manager.close_idle()
+    _shutdown_verify_executor()
 
 
 def block(fn, *args, **kwargs):
@@ -99,18 +202,70 @@ def resolve(url, server=None):
     return block(_resolve, url, server=server)
 
 
+async def _server_available(server):
+    """Check the circuit breaker of a server.
+
+    If the breaker is half-open, the server is probed with `_ping_single`
+    first. Only one probe is sent at a time; concurrent callers treat the
+    server as unavailable until the probe has completed.
+
+    Returns
+    -------
+    bool
+        True if requests may be sent to the server.
+    """
+    breaker = BREAKERS[server]
+    state = breaker.state
+    if state == breaker.CLOSED:
+        return True
+    if state == breaker.OPEN or breaker.probing:
+        return False
+    breaker.probing = True
+    try:
+        _, status = await _ping_single(server)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        status = None
+    finally:
+        breaker.probing = False
+    if status == 200:
+        breaker.success()
+        return True
+    breaker.failure()
+    return False
+
+
+async def _check_available(server):
+    if not await _server_available(server):
+        raise ServerUnavailableError(
+            '{} is unavailable for another {:.1f}s'.format(
+                server, BREAKERS[server].retry_in()))
+
+
+def _record_status(server, status):
+    """Update the circuit breaker of a server given an HTTP status code."""
+    if status >= 500 or status == 429:
+        BREAKERS[server].failure()
+    else:
+        BREAKERS[server].success()
+
+
 async def _resolve(url, server=None):
     if server is None:
         server = _get_server_from_url(url)
 
-    async with QUERY[server].get(url) as response:
-        return await response.text()
+    await _check_available(server)
+    try:
+        with metrics.LATENCY.time(operation='resolve', server=server):
+            async with QUERY[server].get(url) as response:
+                text = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        BREAKERS[server].failure()
+        raise
+    _record_status(server, response.status)
+    return text
 
 
-async def get_total_results(url):
-    response = await _resolve(url)
-    xml = response.encode('utf-8')
-    root = ET.fromstring(xml)
+def _total_results(root, url=None):
     try:
         total_results = int(root.find('os:totalResults', PREFIXES).text)
     except TypeError:
@@ -121,6 +276,13 @@ async def get_total_results(url):
     return total_results
 
 
+async def get_total_results(url):
+    response = await _resolve(url)
+    xml = response.encode('utf-8')
+    root = ET.fromstring(xml)
+    return _total_results(root, url)
+
+
 async def _ping_single(server):
     cfg = CONFIG['SERVERS'][server]
     url = '{host}/search?q=*:*'.format(host=cfg['host'])
@@ -128,9 +290,471 @@ async def _ping_single(server):
         return (server, response.status)
 
 
+# The md5 hash objects of interrupted downloads, as
+# {destination: (offset, hash object)}. This allows a retry within the same
+# process to continue hashing without rereading the partial file.
+_PARTIAL_MD5 = {}
+
+
+def _read_progress(destination):
+    """Return the number of bytes of a partial download known to be valid.
+
+    The progress is read from the sidecar file next to the partial download.
+    If there is no sidecar file, the size of the partial download is used.
+    """
+    size = os.path.getsize(destination)
+    try:
+        with open(destination + PROGRESS_SUFFIX, 'r') as f:
+            offset = int(json.load(f)['offset'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return size
+    return min(offset, size)
+
+
+def _write_progress(destination, offset):
+    """Save the number of valid bytes of a partial download to a sidecar."""
+    sidecar = destination + PROGRESS_SUFFIX
+    with open(sidecar + '.tmp', 'w') as f:
+        json.dump({'offset': offset}, f)
+    os.replace(sidecar + '.tmp', sidecar)
+
+
+def _remove_progress(destination):
+    _PARTIAL_MD5.pop(destination, None)
+    try:
+        os.remove(destination + PROGRESS_SUFFIX)
+    except OSError:
+        pass
+
+
+async def _resume_md5(destination, offset):
+    """Return the md5 hash object of the first `offset` bytes of a partial
+    download.
+
+    Reuses the hash state of a previous attempt in the same process if
+    available. Otherwise, the partial file is rehashed in bounded chunks in a
+    worker thread.
+    """
+    state = _PARTIAL_MD5.pop(destination, None)
+    if state is not None and state[0] == offset:
+        return state[1]
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, checksum.md5_hash,
+                                      destination, offset)
+
+
+def _chunk_size():
+    return int(CONFIG['GENERAL'].get('CHUNK_SIZE', CHUNK // 1024) * 1024)
+
+
+def _preallocate(f, size):
+    """Reserve disk space for a file of the given size.
+
+    Returns
+    -------
+    bool
+        True if the space has been allocated, False if not supported.
+    """
+    if not CONFIG['GENERAL'].get('PREALLOCATE', True) or \
+            not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        return False
+    return True
+
+
+def _write_buffers(f, buffers):
+    """Write a list of buffers to a file.
+
+    For unbuffered files, the buffers are passed to the kernel in a single
+    `writev` system call without joining or copying them.
+    """
+    if not isinstance(f, io.FileIO) or not hasattr(os, 'writev'):
+        for data in buffers:
+            f.write(data)
+        return
+    views = [memoryview(data) for data in buffers]
+    while views:
+        n = os.writev(f.fileno(), views)
+        # Drop the buffers that have been written completely.
+        while views and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if n > 0:
+            views[0] = views[0][n:]
+
+
+class FileLock():
+    """
+    An advisory lock on a file that is shared between processes.
+
+    The lock is held on a separate file `path + LOCK_SUFFIX`, which is
+    removed on release. The lock is released automatically by the operating
+    system if the process dies. On systems without `fcntl`, locking is a
+    no-op.
+
+    Parameters
+    ----------
+    path : str
+        The file to lock.
+    """
+    def __init__(self, path):
+        self.path = path + LOCK_SUFFIX
+        self._fd = None
+
+    def try_acquire(self):
+        """Acquire the lock without waiting.
+
+        Returns
+        -------
+        bool
+            True if the lock was acquired, False if it is held by someone
+            else.
+        """
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        while self._fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (BlockingIOError, PermissionError):
+                os.close(fd)
+                return False
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(fd).st_ino:
+                self._fd = fd
+            else:
+                # The lock file was removed by the previous owner after we
+                # opened it. Try again with a new file.
+                os.close(fd)
+        return True
+
+    async def acquire(self, interval=None):
+        """Wait until the lock can be acquired.
+
+        Parameters
+        ----------
+        interval : float, optional
+            The polling interval in seconds
+            (default: CONFIG['GENERAL']['RECONNECT_TIME']).
+        """
+        if interval is None:
+            interval = CONFIG['GENERAL']['RECONNECT_TIME']
+        while not self.try_acquire():
+            await asyncio.sleep(interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        os.close(self._fd)
+        self._fd = None
+
+
+class StreamWriter():
+    """
+    Write (and hash) a byte stream in a worker thread.
+
+    Chunks are put into a bounded queue and written to the file in order by
+    a worker thread, so that reading from the network overlaps with disk
+    writes and hashing. When the queue is full, `write()` blocks until the
+    worker has caught up, which applies backpressure to the network stream.
+
+    Parameters
+    ----------
+    f : file object
+        The file to write to, opened in binary mode.
+    hash_md5 : hashlib.md5, optional
+        If given, the hash object is updated with all data written.
+    offset : int, optional
+        The number of bytes already in the file (default: 0).
+    progress : function, optional
+        Called from the worker thread with the number of bytes in the file
+        after flushing it, every `PROGRESS_INTERVAL` bytes and on close.
+    maxsize : int, optional
+        The maximum number of chunks held in the queue
+        (default: CONFIG['GENERAL']['WRITE_QUEUE']).
+    """
+    def __init__(self, f, hash_md5=None, offset=0, progress=None,
+                 maxsize=None):
+        if maxsize is None:
+            maxsize = CONFIG['GENERAL'].get('WRITE_QUEUE', 16)
+        self.written = offset
+        self._file = f
+        self._hash = hash_md5
+        self._progress = progress
+        self._checkpoint = offset
+        self._error = None
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._worker = asyncio.ensure_future(self._run())
+
+    def _process(self, batch):
+        _write_buffers(self._file, batch)
+        if self._hash is not None:
+            for data in batch:
+                self._hash.update(data)
+        self.written += sum(len(data) for data in batch)
+        if self._progress is not None and \
+                self.written - self._checkpoint >= PROGRESS_INTERVAL:
+            self._checkpoint = self.written
+            self._file.flush()
+            self._progress(self.written)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        done = False
+        while not done:
+            # Process all chunks that are currently queued at once.
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if self._error is not None or len(batch) == 0:
+                # Keep draining the queue so that `write()` never blocks.
+                continue
+            try:
+                await loop.run_in_executor(None, self._process, batch)
+            except Exception as e:
+                self._error = e
+
+    async def write(self, data):
+        if self._error is not None:
+            raise self._error
+        await self._queue.put(data)
+
+    async def close(self):
+        """Wait for all queued chunks to be written and flush the file.
+
+        If cancelled, wait until the worker thread has stopped writing, so
+        that the file can be closed safely.
+        """
+        stopping = False
+        try:
+            await self._queue.put(None)
+            stopping = True
+            await asyncio.shield(self._worker)
+        except asyncio.CancelledError:
+            # Skip the remaining chunks.
+            self._error = asyncio.CancelledError()
+            if not stopping:
+                await self._queue.put(None)
+            await self._worker
+            raise
+        if self._error is not None:
+            raise self._error
+        self._file.flush()
+        if self._progress is not None:
+            self._progress(self.written)
+
+
+def _download_timeout():
+    """The timeout of download requests.
+
+    There is no limit on the total duration, but a download is aborted if no
+    data has been received for `CONFIG['GENERAL']['STALL_TIMEOUT']` seconds.
+    """
+    return aiohttp.ClientTimeout(
+        total=None, sock_connect=CONFIG['GENERAL']['TIMEOUT'],
+        sock_read=CONFIG['GENERAL'].get('STALL_TIMEOUT'))
+
+
+def _check_busy(server, response):
+    """Reduce the concurrency of a server and raise `ServerBusyError` if the
+    response indicates that the server is overloaded."""
+    if response.status in (429, 503):
+        metrics.BUSY.inc(server=server, status=response.status)
+        LIMITS[server].backoff('HTTP {}'.format(response.status))
+        raise ServerBusyError('{} responded with HTTP {}'.format(
+            server, response.status))
+
+
+async def _receive(response, writer, server, pbar):
+    """Pass the body of a response to a `StreamWriter`.
+
+    Applies the bandwidth limits and updates the progress bars.
+    The writer is closed in any case.
+    """
+    limit = LIMITS[server]
+    metrics.ACTIVE.inc(server=server)
+    try:
+        async for data in response.content.iter_chunked(_chunk_size()):
+            await writer.write(data)
+            await BANDWIDTH.consume(server, len(data))
+            limit.record(len(data))
+            metrics.BYTES.inc(len(data), server=server)
+            if limit.throughput is not None:
+                metrics.THROUGHPUT.set(limit.throughput, server=server)
+            tty.screen.status(progress=len(data))
+            pbar.update(len(data))
+    finally:
+        metrics.ACTIVE.dec(server=server)
+        await writer.close()
+
+
+def _content_range_size(response):
+    """Return the total size in the Content-Range header of a response, or
+    None."""
+    # Example: 'bytes 0-0/12345' or 'bytes */12345'
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+async def _get_remote_size(url):
+    """Determine the size of a remote file if the server supports ranges.
+
+    Parameters
+    ----------
+    url : str
+        The source URL.
+
+    Returns
+    -------
+    int or None
+        The size of the remote file in bytes, or None if the server does not
+        support HTTP Range requests.
+    """
+    server = _get_server_from_url(url)
+    headers = {'Range': 'bytes=0-0'}
+    async with DOWNLOAD[server].get(url, headers=headers) as response:
+        if response.status != 206:
+            return None
+        return _content_range_size(response)
+
+
+async def _download_segment(url, destination, start, end, pbar):
+    """Download the byte range [start, end] of a file into `destination`.
+
+    The destination file must already exist and is written in place.
+
+    Returns
+    -------
+    bool
+        True if the full segment was received, False otherwise.
+    """
+    server = _get_server_from_url(url)
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    async with LIMITS[server], \
+            DOWNLOAD[server].get(url, timeout=_download_timeout(),
+                                 headers=headers) \
+            as response:
+        _check_busy(server, response)
+        if response.status != 206:
+            return False
+        with open(destination, 'r+b', buffering=0) as f:
+            f.seek(start)
+            writer = StreamWriter(f, offset=start)
+            await _receive(response, writer, server, pbar)
+    return writer.written == end + 1
+
+
+async def _download_segmented(url, destination, return_md5=False,
+                              segments=2):
+    """Download a file in concurrent HTTP Range segments.
+
+    The target file is preallocated to its final size and each segment is
+    written into place. All segments share the connection limit of the
+    `DOWNLOAD` session of the server.
+
+    Parameters
+    ----------
+    url : str
+        The source URL.
+    destination : str
+        The local target file path.
+    return_md5 : bool, optional
+        Whether to compute and return the md5 hash sum (default: False).
+    segments : int, optional
+        The maximum number of segments (default: 2).
+
+    Returns
+    -------
+    bool or None
+        True if successful, False otherwise. None if the server does not
+        support segmented downloads.
+    """
+    size = await _get_remote_size(url)
+    if size is None:
+        return None
+
+    min_size = int(CONFIG['GENERAL'].get('SEGMENT_SIZE', 16) * 1024**2)
+    segments = max(1, min(segments, size // max(min_size, 1)))
+    if segments < 2:
+        return None
+
+    path, file_name = os.path.split(destination)
+    pbar_key = file_name.rstrip(DOWNLOAD_SUFFIX)
+    pbar = tty.screen[pbar_key]
+    pbar.n = 0
+    pbar.total = size
+    pbar.refresh()
+
+    with open(destination, 'wb') as f:
+        if not _preallocate(f, size):
+            f.truncate(size)
+    # A crash leaves a preallocated file that must not be continued.
+    _write_progress(destination, 0)
+
+    bounds = [size * i // segments for i in range(segments + 1)]
+    tasks = [asyncio.ensure_future(
+                _download_segment(url, destination, bounds[i],
+                                  bounds[i + 1] - 1, pbar))
+             for i in range(segments)]
+    complete = False
+    try:
+        complete = all(await asyncio.gather(*tasks))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug('{} Segmented download failed: {}'.format(file_name, e))
+    finally:
+        if not complete:
+            for task in tasks:
+                task.cancel()
+            # Wait until no segment writes to the file anymore.
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # A partially filled preallocated file cannot be resumed.
+            os.remove(destination)
+            _remove_progress(destination)
+
+    if not complete:
+        return (False, None) if return_md5 else False
+
+    # The progress is kept until the file has been verified.
+    _write_progress(destination, size)
+
+    if return_md5:
+        loop = asyncio.get_event_loop()
+        local_md5 = await loop.run_in_executor(None, checksum.md5,
+                                               destination)
+        return (True, local_md5)
+    else:
+        return True
+
+
 async def _download(url, destination, return_md5=False, cont=True):
     """Downloads a file from the remote server into the specified destination.
 
+    If `CONFIG['GENERAL']['SEGMENTS']` is larger than 1 and there is no
+    partial download to continue, the file is downloaded in concurrent
+    segments (see `_download_segmented`).
+
+    The progress sidecar of a completed download is kept, so that an
+    interruption before the file has been verified doesn't require another
+    transfer. It is removed by `_remove_progress`.
+
     Parameters
     ----------
     url : str
@@ -152,38 +776,96 @@ async def _download(url, destination, return_md5=False, cont=True):
     os.makedirs(path, exist_ok=True)
     pbar_key = file_name.rstrip(DOWNLOAD_SUFFIX)
 
+    segments = CONFIG['GENERAL'].get('SEGMENTS', 1)
+    if segments > 1 and not (cont and os.path.isfile(destination)):
+        result = await _download_segmented(url, destination,
+                                           return_md5=return_md5,
+                                           segments=segments)
+        if result is not None:
+            return result
+
     if return_md5:
         hash_md5 = hashlib.md5()
 
     headers = {}
     if cont and os.path.isfile(destination):
-        local_size = os.path.getsize(destination)
+        local_size = _read_progress(destination)
+        if local_size < os.path.getsize(destination):
+            # Discard any bytes written after the last saved progress.
+            with open(destination, 'r+b') as f:
+                f.truncate(local_size)
         headers['Range'] = 'bytes={}-'.format(local_size)
-        with open(destination, 'rb') as f:
-            hash_md5.update(f.read())
+        if return_md5:
+            hash_md5 = await _resume_md5(destination, local_size)
         tty.screen.status(progress=local_size)
     else:
+        cont = False
         local_size = 0
 
     server = _get_server_from_url(url)
-    async with DOWNLOAD[server].get(url, timeout=None, headers=headers) \
+    async with LIMITS[server], \
+            DOWNLOAD[server].get(url, timeout=_download_timeout(),
+                                 headers=headers) \
             as response:
-        size = int(response.headers['Content-Length'])
-        # Create progress bar only now:
-        pbar = tty.screen[pbar_key]
-        pbar.n = local_size
-        pbar.total = size + local_size
-        pbar.refresh()
-
-        mode = 'ab' if cont else 'wb'
-        with open(destination, mode) as f:
-            async for data in response.content.iter_chunked(CHUNK):
-                if return_md5:
-                    hash_md5.update(data)
-                f.write(data)
-                progress = len(data)
-                tty.screen.status(progress=progress)
-                pbar.update(len(data))
+        _check_busy(server, response)
+        #
+        # If the server ignored the Range header or the local file is
+        # larger than the remote one, start over.
+        #
+        # The transfer has already been completed by an earlier call.
+        done = cont and response.status == 416 and \
+            _content_range_size(response) == local_size
+        restart = cont and response.status != 206 and not done
+        failed = response.status >= 400 and not restart and not done
+        if not restart and not failed and not done:
+            size = int(response.headers['Content-Length'])
+            # Create progress bar only now:
+            pbar = tty.screen[pbar_key]
+            pbar.n = local_size
+            pbar.total = size + local_size
+            pbar.refresh()
+
+            def _save_progress(offset):
+                _write_progress(destination, offset)
+
+            #
+            # The file is opened unbuffered and preallocated to its final
+            # size. Received chunks are written in place at the current
+            # offset, without passing through an intermediate buffer.
+            #
+            mode = 'r+b' if cont else 'wb'
+            with open(destination, mode, buffering=0) as f:
+                f.seek(local_size)
+                _write_progress(destination, local_size)
+                _preallocate(f, local_size + size)
+                #
+                # Disk writes and hashing happen in a worker thread.
+                # The progress is saved regularly so an interrupted download
+                # can be continued.
+                #
+                writer = StreamWriter(
+                    f, hash_md5=hash_md5 if return_md5 else None,
+                    offset=local_size, progress=_save_progress)
+                try:
+                    await _receive(response, writer, server, pbar)
+                finally:
+                    # Release the preallocated space of an incomplete file.
+                    f.truncate(writer.written)
+                    if return_md5:
+                        _PARTIAL_MD5[destination] = (writer.written,
+                                                     hash_md5)
+
+    if failed:
+        logger.debug('{} Download failed (HTTP {}).'.format(
+            file_name, response.status))
+        _record_status(server, response.status)
+        return (False, None) if return_md5 else False
+
+    if restart:
+        logger.debug('{} Cannot continue download (HTTP {}), '
+                     'restarting.'.format(file_name, response.status))
+        return await _download(url, destination, return_md5=return_md5,
+                               cont=False)
 
     # if pbar is not None:
     #     pbar.close()
@@ -197,68 +879,188 @@ async def _download(url, destination, return_md5=False, cont=True):
 # -----------------------------------------------------------------------------
 # XML PARSING
 # -----------------------------------------------------------------------------
-def parse_page(xml):
-    file_list = []
-
-    try:
-        root = ET.fromstring(xml)
-        # try:
-        #     total_results = int(root.find('os:totalResults', PREFIXES).text)
-        # except TypeError:
-        #     total_results = 0
-
-        for entry in root.findall('doc:entry', PREFIXES):
-
-            filename = entry.find("./doc:str[@name='identifier']",
-                                  PREFIXES).text
-            ingestiondate = utils.to_date(
-                entry.find("./doc:date[@name='ingestiondate']", PREFIXES).text,
-                output='date')
+# Element tags of the search results, for parsing without XPath
+_ATOM = '{%s}' % PREFIXES['doc']
+_ENTRY_TAG = _ATOM + 'entry'
+_TITLE_TAG = _ATOM + 'title'
+_LINK_TAG = _ATOM + 'link'
+_ID_TAG = _ATOM + 'id'
+_STR_TAG = _ATOM + 'str'
+_INT_TAG = _ATOM + 'int'
+_DATE_TAG = _ATOM + 'date'
+_TOTAL_RESULTS_TAG = '{%s}totalResults' % PREFIXES['os']
+_GML_COORDINATES = re.compile('<gml:coordinates>(.*)</gml:coordinates>')
+_GML_OPEN = '<gml:coordinates>'
+_GML_CLOSE = '</gml:coordinates>'
+_UTC = tzutc()
+
+
+def _parse_date(text):
+    """Parse an ingestion date such as '2018-01-01T10:00:33.123Z'.
+
+    Dates in this format are parsed directly, all others with
+    `utils.to_date`.
+    """
+    if len(text) >= 20 and text[-1] == 'Z' and text[4] == '-' and \
+            text[7] == '-' and text[10] == 'T' and text[13] == ':' and \
+            text[16] == ':':
+        fraction = text[20:-1]
+        if (len(text) == 20 or (text[19] == '.' and len(fraction) <= 6 and
+                                fraction.isdigit())) and \
+                (text[0:4] + text[5:7] + text[8:10] + text[11:13] +
+                 text[14:16] + text[17:19]).isdigit():
             try:
-                footprint_tag = entry.find("./doc:str[@name='gmlfootprint']",
-                                           PREFIXES).text
-                match = re.search('<gml:coordinates>(.*)</gml:coordinates>',
-                                  footprint_tag)
-                coords = geo.gml_to_polygon(match.groups()[0])
-            except AttributeError:
-                coords = None
-
-            filesize = utils.h2b(entry.find("./doc:str[@name='size']",
-                                            PREFIXES).text)
-            preview_url = entry.find("./doc:link[@rel='icon']",
-                                     PREFIXES).attrib['href']
+                return datetime(
+                    int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                    int(text[11:13]), int(text[14:16]), int(text[17:19]),
+                    int(fraction.ljust(6, '0')) if fraction else 0,
+                    tzinfo=_UTC)
+            except ValueError:
+                pass
+    return utils.to_date(text, output='date')
+
+
+def _footprint_coordinates(footprint):
+    """Extract the coordinates from a GML footprint, or None."""
+    start = footprint.find(_GML_OPEN)
+    if start == -1:
+        return None
+    start += len(_GML_OPEN)
+    line_end = footprint.find('\n', start)
+    if line_end == -1:
+        line_end = len(footprint)
+    end = footprint.rfind(_GML_CLOSE, start, line_end)
+    if end == -1:
+        # The first tag is not closed on the same line.
+        match = _GML_COORDINATES.search(footprint)
+        return None if match is None else match.group(1)
+    return footprint[start:end]
+
+
+def _parse_entry(entry, hosts):
+    """Parse a single search result.
+
+    The children of the entry are visited only once. As with
+    `Element.find`, the first element of each kind is used. `hosts` caches
+    the result of `_get_host_from_url` for the part of the download URLs
+    that precedes '/odata/', which determines it.
+    """
+    title = link = icon = uuid = None
+    strs = {}
+    ints = {}
+    dates = {}
+    for child in entry:
+        tag = child.tag
+        if tag == _STR_TAG:
+            name = child.get('name')
+            if name not in strs:
+                strs[name] = child
+        elif tag == _DATE_TAG:
+            name = child.get('name')
+            if name not in dates:
+                dates[name] = child
+        elif tag == _INT_TAG:
+            name = child.get('name')
+            if name not in ints:
+                ints[name] = child
+        elif tag == _LINK_TAG:
+            if link is None:
+                link = child
+            if icon is None and child.get('rel') == 'icon':
+                icon = child
+        elif tag == _TITLE_TAG:
+            if title is None:
+                title = child
+        elif tag == _ID_TAG:
+            if uuid is None:
+                uuid = child
+
+    filename = strs.get('identifier').text
+    ingestiondate = _parse_date(dates.get('ingestiondate').text)
+    coords = None
+    if 'gmlfootprint' in strs and strs['gmlfootprint'].text is not None:
+        coordinates = _footprint_coordinates(strs['gmlfootprint'].text)
+        if coordinates is not None:
             try:
-                rel_orbit = int(entry.find(
-                    "doc:int[@name='relativeorbitnumber']", PREFIXES).text)
+                coords = geo.gml_to_polygon(coordinates)
             except AttributeError:
-                rel_orbit = None
+                pass
+
+    rel_orbit = ints.get('relativeorbitnumber')
+    if rel_orbit is not None:
+        rel_orbit = int(rel_orbit.text)
+    orbit_dir = None
+    if 'orbitdirection' in strs and strs['orbitdirection'].text is not None:
+        orbit_dir = strs['orbitdirection'].text.upper()
+
+    url = link.attrib['href']
+    prefix = url.find('/odata/')
+    if prefix == -1:
+        host = _get_host_from_url(url)
+    else:
+        prefix = url[:prefix]
+        if prefix not in hosts:
+            hosts[prefix] = _get_host_from_url(url)
+        host = hosts[prefix]
+    return {
+        'title': title.text,
+        'url': url,
+        'preview': icon.attrib['href'],
+        'uuid': uuid.text,
+        'filename': filename,
+        'size': utils.h2b(strs.get('size').text),
+        'ingestiondate': ingestiondate,
+        'coords': coords,
+        'orbit_direction': orbit_dir,
+        'rel_orbit': rel_orbit,
+        'host': host
+    }
+
+
+def _parse_feed(xml):
+    """Parse a page of search results.
+
+    The page is parsed incrementally, and each entry is discarded from the
+    tree once it has been converted.
 
-            try:
-                orbit_dir = entry.find("doc:str[@name='orbitdirection']",
-                                       PREFIXES).text.upper()
-            except AttributeError:
-                orbit_dir = None
-
-            file_dict = {
-                'title': entry.find('doc:title', PREFIXES).text,
-                'url': entry.find('doc:link', PREFIXES).attrib['href'],
-                'preview': preview_url,
-                'uuid': entry.find('doc:id', PREFIXES).text,
-                'filename': filename,
-                'size': filesize,
-                'ingestiondate': ingestiondate,
-                'coords': coords,
-                'orbit_direction': orbit_dir,
-                'rel_orbit': rel_orbit
-            }
-            file_dict['host'] = _get_host_from_url(file_dict['url'])
-            file_list.append(file_dict)
+    Parameters
+    ----------
+    xml : bytes
+        The OpenSearch response.
 
+    Returns
+    -------
+    tuple of (int or None, list of dict)
+        The total number of results of the query (None if not given) and
+        the results on the page.
+
+    Raises
+    ------
+    lxml.etree.XMLSyntaxError
+        If the page is not valid XML.
+    """
+    total_results = None
+    file_list = []
+    hosts = {}
+    for _, element in ET.iterparse(io.BytesIO(xml), events=('end',),
+                                   tag=(_ENTRY_TAG, _TOTAL_RESULTS_TAG)):
+        if element.tag == _ENTRY_TAG:
+            file_list.append(_parse_entry(element, hosts))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif total_results is None:
+            total_results = 0 if element.text is None else \
+                int(element.text)
+    return total_results, file_list
+
+
+def parse_page(xml):
+    try:
+        return _parse_feed(xml)[1]
     except ET.XMLSyntaxError:
         # not valid XML
-        file_list = []
-
-    return file_list
+        return []
 
 
 async def _files_from_url(url, verbose=False):
@@ -269,31 +1071,124 @@ async def _files_from_url(url, verbose=False):
     return result
 
 
-async def _get_file_list_from_url(url, limit=None, verbose=False):
-    # Parse first page to get total number of results.
-    total_results = await get_total_results(url)
-    host = urlparse(url).netloc
+async def _first_page_from_url(url, verbose=False):
+    """Return the total number of results of a query URL together with the
+    results on its first page, from a single request."""
+    xml = await _resolve(url)
+    total_results, result = _parse_feed(xml.encode('utf-8'))
+    if total_results is None:
+        raise AttributeError("Could not extract total results from URL "
+                             "{}".format(url))
     if verbose and total_results > 0:
-        tty.screen.status(desc='Querying {host}'.format(host=host),
+        tty.screen.status(desc='Querying {host}'.format(
+                              host=urlparse(url).netloc),
                           total=total_results, mode='bar')
+        tty.screen.status(progress=len(result))
+    return total_results, result
+
+
+async def _iter_file_list_from_url(url, limit=None, verbose=False):
+    """Yield the search results of all pages of a query URL.
+
+    The results are yielded in page order, as soon as each page has been
+    parsed. At most CONFIG['GENERAL']['PAGE_WINDOW'] pages are requested or
+    waiting to be consumed at any time; the next page is requested as soon
+    as the oldest one is consumed.
+
+    Complete result lists of up to CONFIG['GENERAL']['QUERY_CACHE_RESULTS']
+    products are stored in the query cache (see `cache.QueryCache`).
+
+    Parameters
+    ----------
+    url : str
+        The URL of the first page.
+    limit : int, optional
+        The maximum number of results.
+    verbose : bool, optional
+        Whether to show the progress.
+    """
+    store = cache.query_cache()
+    if store is not None:
+        cached = store.get(url)
+        if cached is not None:
+            logger.debug('Using cached results of {}'.format(url))
+            if verbose:
+                tty.screen.status(progress=len(cached[:limit]))
+            for product in cached[:limit]:
+                yield product
+            return
+
+    if limit is not None:
+        # Don't request more rows than needed, so that small lookups are
+        # answered in a single round trip.
+        url = _limit_rows(url, limit)
+
+    # The first page provides the total number of results.
+    total_results, first_page = await _first_page_from_url(
+        url, verbose=verbose)
 
     if limit is None:
         total = total_results
     else:
         total = min(limit, total_results)
 
-    urls = [url] + [u for u in _generate_next_url(url, total=total)]
+    # Only complete result lists are cached.
+    results = None
+    if store is not None and total == total_results and total_results <= \
+            CONFIG['GENERAL'].get('QUERY_CACHE_RESULTS', 10000):
+        results = []
+
+    window = max(1, CONFIG['GENERAL'].get('PAGE_WINDOW') or
+                 CONFIG['GENERAL']['N_SCIHUB_QUERIES'])
+    urls = _generate_next_url(url, total=total)
+    pages = collections.deque()
+    first = asyncio.get_event_loop().create_future()
+    first.set_result(first_page)
+    pages.append(first)
+
+    def _fill():
+        for u in itertools.islice(urls, window - len(pages)):
+            pages.append(asyncio.ensure_future(
+                _files_from_url(u, verbose=verbose)))
+
+    count = 0
+    try:
+        _fill()
+        while pages:
+            page = await pages.popleft()
+            _fill()
+            for product in page:
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                if results is not None:
+                    results.append(dict(product))
+                yield product
+        if results is not None:
+            store.set(url, results)
+    finally:
+        for task in pages:
+            task.cancel()
 
-    tasks = [_files_from_url(u, verbose=verbose) for u in urls]
-    results = await asyncio.gather(*tasks)
-    result = utils.flatten(results)
 
-    return result
+async def _get_file_list_from_url(url, limit=None, verbose=False):
+    return [product async for product in
+            _iter_file_list_from_url(url, limit=limit, verbose=verbose)]
 
 
 # -----------------------------------------------------------------------------
 # QUERY BUILDING
 # -----------------------------------------------------------------------------
+def _format_time(value):
+    """Format a datetime for an ingestiondate query. Strings (e.g. 'NOW')
+    are passed through."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return datetime.strftime(value, DATETIME_FMT)
+    return value
+
+
 def _parse_time_parameter(value):
     # Default ingestiontime query parameters
     start = '1970-01-01T00:00:00.000Z'
@@ -316,6 +1211,13 @@ def _parse_time_parameter(value):
                                   - timedelta(1), DATETIME_FMT)
         end = datetime.strftime(datetime.now(pytz.utc), DATETIME_FMT)
 
+    elif isinstance(value, tuple):
+        # (start, end), each a datetime, a formatted string or None
+        if value[0] is not None:
+            start = _format_time(value[0])
+        if value[1] is not None:
+            end = _format_time(value[1])
+
     else:
         parsed = utils.parse_datetime(value)
         if parsed[0] is not None:
@@ -338,6 +1240,7 @@ def _build_query(query={}):
     """
     query_list = []
     sort_string = ''
+    rows = CONFIG['GENERAL']['ENTRIES']
 
     # Default ingestiontime query parameters
     start = '1970-01-01T00:00:00.000Z'
@@ -399,6 +1302,9 @@ def _build_query(query={}):
         elif key == 'sort':
             sort_string = '&orderby={} {}'.format(*query['sort'])
 
+        elif key == 'rows':
+            rows = int(val)
+
         # Not a special keyword. Pass directly to SciHub
         else:
             query_list.append('{}:{}'.format(key, val))
@@ -425,7 +1331,7 @@ def _build_query(query={}):
     #
     query_url = 'q={q}&start=0&rows={rows}{sort}'.format(
         q=query_string,
-        rows=CONFIG['GENERAL']['ENTRIES'],
+        rows=rows,
         sort=sort_string
     )
     return query_url
@@ -444,6 +1350,16 @@ def _build_url(query, server):
 # -----------------------------------------------------------------------------
 # UTILITY FUNCTIONS
 # -----------------------------------------------------------------------------
+def _limit_rows(url, limit):
+    """Reduce the number of rows per page of a query URL to `limit`."""
+    parsed_url = urlparse(url)
+    q_params = parse_qs(parsed_url.query)
+    if 'rows' in q_params and int(q_params['rows'][0]) <= limit:
+        return url
+    q_params['rows'] = [max(1, limit)]
+    return parsed_url._replace(query=urlencode(q_params, doseq=True)).geturl()
+
+
 def _generate_next_url(url, total=None):
     parsed_url = urlparse(url)
     q_params = parse_qs(parsed_url.query)
@@ -521,9 +1437,79 @@ def _auto_detect_server_from_query(query, available_only=False):
     return servers
 
 
+def _merge_mirrors(results, unique=None, rank=None):
+    """Merge the search results of the same product from different servers.
+
+    The first result for each product is kept, and the download locations
+    on all servers are collected in its `mirrors` entry.
+
+    Parameters
+    ----------
+    results : list of dict
+        The search results.
+    unique : dict, optional
+        The mirrors of the products merged so far, as {filename: mirrors}.
+        Pass the same dict to merge results as they arrive. Only the mirrors
+        are kept, so that the products themselves can be released once they
+        have been consumed.
+    rank : callable, optional
+        Returns the server preference of a mirror (lower is better). By
+        default, the mirrors are kept in the order of the results.
+
+    Returns
+    -------
+    list of dict
+        The products that have not been merged before.
+    """
+    if unique is None:
+        unique = {}
+    new = []
+    for result in results:
+        mirror = {'url': result['url'],
+                  'host': result['host'],
+                  'uuid': result['uuid']}
+        mirrors = unique.get(result['filename'])
+        if mirrors is None:
+            result['mirrors'] = unique[result['filename']] = [mirror]
+            new.append(result)
+        elif mirror not in mirrors:
+            if rank is None:
+                mirrors.append(mirror)
+            else:
+                index = len([m for m in mirrors if rank(m) <= rank(mirror)])
+                mirrors.insert(index, mirror)
+    return new
+
+
+def _rank_mirrors(product):
+    """Return the download locations of a product, fastest first.
+
+    Servers that have not been measured yet are tried first, in order of
+    preference. The remaining servers are ordered by their most recently
+    observed download throughput. Servers whose circuit breaker is open come
+    last.
+    """
+    mirrors = product.get('mirrors')
+    if not mirrors:
+        mirrors = [{'url': product['url'],
+                    'host': product['host'],
+                    'uuid': product['uuid']}]
+
+    def _key(mirror):
+        server = _get_server_from_url(mirror['url'])
+        throughput = LIMITS[server].throughput
+        if BREAKERS[server].state == throttle.CircuitBreaker.OPEN:
+            return (2, 0)
+        elif throughput is None:
+            return (0, 0)
+        return (1, -throughput)
+
+    return sorted(mirrors, key=_key)
+
+
 async def _uuid_from_identifier(identifier):
     identifier = os.path.splitext(os.path.split(identifier)[1])[0]
-    results = await _search({'identifier': identifier+'*'})
+    results = await _search({'identifier': identifier+'*'}, limit=1)
     if len(results) == 0:
         raise NotFoundError('Product not found: {}'.format(identifier))
     return results[0]['uuid']
@@ -531,7 +1517,7 @@ async def _uuid_from_identifier(identifier):
 
 async def _host_and_uuid_from_identifier(identifier):
     identifier = os.path.splitext(os.path.split(identifier)[1])[0]
-    results = await _search({'identifier': identifier+'*'})
+    results = await _search({'identifier': identifier+'*'}, limit=1)
     if len(results) == 0:
         raise NotFoundError('Product not found: {}'.format(identifier))
     return (results[0]['host'], results[0]['uuid'])
@@ -600,6 +1586,29 @@ def search(*args, **kwargs):
     return block(_search, *args, **kwargs)
 
 
+def iter_search(*args, **kwargs):
+    """Search SciHub and yield the results as they arrive.
+
+    This is the synchronous version of `_iter_search`, and takes the same
+    arguments as `search`.
+
+    Yields
+    ------
+    dict
+        The search results.
+    """
+    results = _iter_search(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(results.aclose())
+
+
 async def _search(query={}, server='auto', limit=None, verbose=False,
                   **kwargs):
     """ Search SciHub for satellite products.
@@ -622,6 +1631,27 @@ async def _search(query={}, server='auto', limit=None, verbose=False,
     list of dict
         A list of dictionaries representing the found search results.
     """
+    return [product async for product in
+            _iter_search(query, server=server, limit=limit, verbose=verbose,
+                         **kwargs)]
+
+
+async def _iter_search(query={}, server='auto', limit=None, verbose=False,
+                       **kwargs):
+    """Search SciHub for satellite products and yield the results as the
+    pages arrive.
+
+    Products found on multiple servers are only yielded once. Locations on
+    other servers found later are added to the `mirrors` of the product that
+    has already been yielded, in order of server preference.
+
+    See `_search` for the parameters.
+
+    Yields
+    ------
+    dict
+        The search results.
+    """
     #
     # Search in each server.
     #
@@ -638,50 +1668,180 @@ async def _search(query={}, server='auto', limit=None, verbose=False,
 
     if servers is None:
         servers = []
+    #
+    # Skip servers that are known to be down, if there are others.
+    #
+    available = [s for s in servers if await _server_available(s)]
+    if len(available) > 0:
+        servers = available
     query_string = _build_query(query)
 
-    tasks = []
-    for servername in servers:
-        server = CONFIG['SERVERS'][servername]
+    #
+    # The results of all servers are passed through a bounded queue, so
+    # that the pagination waits if the results are not consumed.
+    #
+    queue = asyncio.Queue(maxsize=CONFIG['GENERAL']['ENTRIES'])
+
+    succeeded = []
+    errors = []
+
+    async def _produce(servername):
         url = '{url}/search?{q}'.format(
-            url=server['host'], q=query_string
+            url=CONFIG['SERVERS'][servername]['host'], q=query_string
         )
         logger.debug('Trying server {}: {}'.format(servername, url))
-        tasks.append(
-            _get_file_list_from_url(url, limit=limit, verbose=verbose)
-        )
-    results = await asyncio.gather(*tasks)
-    results = utils.flatten(results)
+        try:
+            async for product in _iter_file_list_from_url(
+                    url, limit=limit, verbose=verbose):
+                await queue.put(product)
+            succeeded.append(servername)
+        except Exception as e:
+            # The search goes on with the other servers, so the results may
+            # be incomplete. This must not go unnoticed.
+            logging.warning('Search on {} failed, the results may be '
+                            'incomplete: {}'.format(servername, e))
+            errors.append(e)
+        finally:
+            await queue.put(None)
+
+    producers = [asyncio.ensure_future(_produce(s)) for s in servers]
 
     #
-    # Delete duplicate results (if product is on multiple servers).
-    # TODO: This should be done in the order of preference as
-    # given by CONFIG['SERVERS'] !
+    # Merge duplicate results (if product is on multiple servers).
     #
-    unique = utils.unique_by(results, lambda x: x['filename'])
-    if limit is not None:
-        unique = unique[:limit]
+    preference = {CONFIG['SERVERS'][s]['host']: i
+                  for i, s in enumerate(servers)}
 
-    return unique
+    def _preference(mirror):
+        return min([i for host, i in preference.items()
+                    if host in mirror['url']] + [len(preference)])
 
+    unique = {}
+    count = 0
+    remaining = len(producers)
+    try:
+        while remaining > 0:
+            product = await queue.get()
+            if product is None:
+                remaining -= 1
+                continue
+            for new in _merge_mirrors([product], unique, rank=_preference):
+                if limit is None or count < limit:
+                    count += 1
+                    yield new
+        if errors and not succeeded:
+            # Don't mistake a failed search for an empty result.
+            raise errors[-1]
+    finally:
+        for producer in producers:
+            producer.cancel()
+
+
+# Remote checksums resolved ahead of the downloads, as
+# {(host, uuid): future}. A result of None means the prefetch failed.
+_MD5_PREFETCH = {}
+
+
+def _md5_key(product):
+    if type(product) is dict and 'uuid' in product and 'host' in product:
+        return (product['host'], product['uuid'])
+    return None
+
+
+async def _prefetch_md5(products, concurrency=None):
+    """Resolve the remote checksums of many products concurrently.
+
+    The results are used by `_md5`, so that verifying a download does not
+    require another request.
 
-async def _md5(product=None, uuid=None):
+    Parameters
+    ----------
+    products : list of dict or async iterable
+        The search results.
+    concurrency : int, optional
+        The maximum number of simultaneous requests
+        (default: CONFIG['GENERAL']['N_SCIHUB_QUERIES']).
+    """
+    if concurrency is None:
+        concurrency = CONFIG['GENERAL']['N_SCIHUB_QUERIES']
+    loop = asyncio.get_event_loop()
+    pending = []
+
+    async def _prefetched():
+        async for product in _aiter(products):
+            key = _md5_key(product)
+            if key is not None and key not in _MD5_PREFETCH:
+                _MD5_PREFETCH[key] = loop.create_future()
+                pending.append(_MD5_PREFETCH[key])
+                yield product, _MD5_PREFETCH[key]
+
+    async def _fetch(item):
+        product, future = item
+        try:
+            result = await _md5(product, prefetched=False)
+        except Exception as e:
+            logger.debug('Checksum prefetch failed for {}: {}'.format(
+                product['filename'], e))
+            result = None
+        if not future.done():
+            future.set_result(result)
+
+    try:
+        await _for_each(_prefetched(), _fetch, concurrency)
+    finally:
+        # Don't leave anyone waiting for a cancelled prefetch.
+        for future in pending:
+            if not future.done():
+                future.set_result(None)
+
+
+async def _md5(product=None, uuid=None, prefetched=True):
+    key = _md5_key(product)
+    if prefetched and key in _MD5_PREFETCH:
+        result = await asyncio.shield(_MD5_PREFETCH[key])
+        if result is not None:
+            return result
+
+    #
+    # The checksum of a product never changes, so it is looked up in the
+    # persistent store first.
+    #
+    store = cache.checksum_store()
+    identifier = host = None
     if product is not None:
         if type(product) is dict and 'uuid' in product and 'host' in product:
-            md5_url = _checksum_url_from_uuid(product['uuid'],
-                                              host=product['host'])
+            uuid, host = product['uuid'], product['host']
+            identifier = product.get('title')
         elif type(product) is str:
-            md5_url = await _checksum_url_from_identifier(product)
+            identifier = product
+            if store is not None:
+                stored = store.get(identifier=identifier)
+                if stored is not None:
+                    return stored
+            host, uuid = await _host_and_uuid_from_identifier(product)
         else:
             return False
 
-    elif uuid is not None:
-        md5_url = _checksum_url_from_uuid(uuid)
+    if store is not None:
+        stored = store.get(uuid=uuid)
+        if stored is not None:
+            return stored
 
+    md5_url = _checksum_url_from_uuid(uuid, host=host)
     server = _get_server_from_url(md5_url)
-    async with QUERY[server].get(md5_url) as response:
-        result = await response.read()
-    return result.decode().lower()
+    await _check_available(server)
+    try:
+        with metrics.LATENCY.time(operation='md5', server=server):
+            async with QUERY[server].get(md5_url) as response:
+                result = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        BREAKERS[server].failure()
+        raise
+    _record_status(server, response.status)
+    result = result.decode().lower()
+    if store is not None and response.status == 200:
+        store.set(uuid, result, identifier=identifier)
+    return result
 
     # if PY2:
     #     return result.lower()
@@ -689,6 +1849,25 @@ async def _md5(product=None, uuid=None):
     #     return result.decode().lower()
 
 
+async def _md5_after_transfer(product):
+    """Return the remote checksum of a product whose transfer has been
+    completed.
+
+    If the circuit breaker of the server has opened in the meantime, wait
+    until the server may be probed again (up to CONFIG['GENERAL']['TRIALS']
+    times), rather than failing the download.
+    """
+    server = _get_server_from_url(product['url'])
+    for i in range(CONFIG['GENERAL']['TRIALS']):
+        try:
+            return await _md5(product)
+        except ServerUnavailableError as e:
+            if i + 1 == CONFIG['GENERAL']['TRIALS']:
+                raise
+            logger.debug('{}: {}'.format(product['filename'], e))
+            await asyncio.sleep(max(BREAKERS[server].retry_in(), 1.0))
+
+
 def md5(product=None, uuid=None):
     """Returns the md5 sum of the file stored on SciHub given the product name
     or uuid.
@@ -713,26 +1892,651 @@ def exists(product):
     return len(search_results) > 0
 
 
+# -----------------------------------------------------------------------------
+# DOWNLOAD SCHEDULING
+# -----------------------------------------------------------------------------
+async def _aiter(products):
+    """Iterate asynchronously over a list or an async iterable."""
+    if hasattr(products, '__aiter__'):
+        async for product in products:
+            yield product
+    else:
+        for product in products:
+            yield product
+
+
+async def _for_each(items, fn, concurrency):
+    """Await `fn(item)` for all items of an async iterable, with at most
+    `concurrency` calls running at the same time.
+
+    The items are only taken from `items` as the calls progress.
+    """
+    queue = asyncio.Queue(maxsize=concurrency)
+
+    async def _worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            await fn(item)
+
+    workers = [asyncio.ensure_future(_worker()) for _ in range(concurrency)]
+    try:
+        async for item in items:
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+class _Slot():
+    """A slot of the download scheduler that can be released only once.
+
+    A worker may release its slot early (e.g. while verifying a completed
+    download) and acquire it again before another transfer.
+    """
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._semaphore.release()
+
+    async def acquire(self):
+        if self._released:
+            await self._semaphore.acquire()
+            self._released = False
+
+
+class DownloadScheduler():
+    """
+    Run downloads with a bounded number of active tasks.
+
+    Products are queued by priority, and a task is only created once a slot
+    is available. Thus, memory usage does not grow with the number of queued
+    products.
+
+    Parameters
+    ----------
+    order : str, optional
+        The order in which products are downloaded. One of
+        - 'smallest' : smallest products first
+        - 'newest' : most recently ingested products first
+        - 'round-robin' : alternate between the hosts of the products
+        - None : the order of the input
+        (default: CONFIG['GENERAL']['DOWNLOAD_ORDER'])
+    active : int, optional
+        The maximum number of active downloads (default:
+        CONFIG['GENERAL']['ACTIVE_DOWNLOADS'], or the sum of the `downloads`
+        of all servers if not set).
+    """
+    ORDERS = (None, 'smallest', 'newest', 'round-robin')
+
+    def __init__(self, order='auto', active=None):
+        if order == 'auto':
+            order = CONFIG['GENERAL'].get('DOWNLOAD_ORDER')
+        if order not in self.ORDERS:
+            raise ValueError("Invalid download order: '{}'".format(order))
+        if active is None:
+            active = CONFIG['GENERAL'].get('ACTIVE_DOWNLOADS')
+        if active is None:
+            active = sum(cfg['downloads']
+                         for cfg in CONFIG['SERVERS'].values())
+        self.order = order
+        self.active = max(1, active)
+        self._host_counter = {}
+
+    def _priority(self, product, index):
+        if type(product) is not dict:
+            return index
+        if self.order == 'smallest':
+            return product.get('size', 0)
+        elif self.order == 'newest':
+            date = product.get('ingestiondate')
+            if isinstance(date, str):
+                date = utils.to_date(date, output='date')
+            return -date.timestamp() if date is not None else 0
+        elif self.order == 'round-robin':
+            host = product.get('host')
+            n = self._host_counter.get(host, 0)
+            self._host_counter[host] = n + 1
+            return n
+        return index
+
+    async def _run_one(self, worker, product, slot, pass_slot):
+        try:
+            if pass_slot:
+                return await worker(product, slot=slot)
+            return await worker(product)
+        except Exception as e:
+            logger.error('Download failed: {}'.format(e))
+            return False
+        finally:
+            slot.release()
+
+    async def run(self, products, worker, pass_slot=False):
+        """Run `worker(product)` for all products.
+
+        Parameters
+        ----------
+        products : list or async iterable
+            The products to download. If an async iterable is given, the
+            downloads start while it is still being consumed, and each
+            product is prioritized among those that have arrived so far.
+        worker : coroutine function
+            Called with each product.
+        pass_slot : bool, optional
+            If True, the slot of the product is passed to `worker` as keyword
+            argument `slot`, so that it can be released before the worker
+            completes (default: False).
+
+        Returns
+        -------
+        list
+            The results of `worker`, in the order of `products`.
+        """
+        queue = []
+        arrived = asyncio.Event()
+        feeder = None
+        if hasattr(products, '__aiter__'):
+            async def _feed():
+                index = 0
+                try:
+                    async for product in products:
+                        heapq.heappush(queue, (self._priority(product, index),
+                                               index, product))
+                        index += 1
+                        arrived.set()
+                finally:
+                    arrived.set()
+
+            feeder = asyncio.ensure_future(_feed())
+        else:
+            for index, product in enumerate(products):
+                heapq.heappush(
+                    queue, (self._priority(product, index), index, product))
+
+        slots = asyncio.Semaphore(self.active)
+        tasks = {}
+        try:
+            while True:
+                await slots.acquire()
+                while not queue and feeder is not None and not feeder.done():
+                    arrived.clear()
+                    await arrived.wait()
+                if not queue:
+                    slots.release()
+                    break
+                _, index, product = heapq.heappop(queue)
+                tasks[index] = asyncio.ensure_future(
+                    self._run_one(worker, product, _Slot(slots), pass_slot))
+            if feeder is not None:
+                # Raise the exception of the feeder, if any.
+                await feeder
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            if feeder is not None:
+                feeder.cancel()
+            raise
+
+        results = await asyncio.gather(*tasks.values())
+        by_index = dict(zip(tasks.keys(), results))
+        return [by_index[i] for i in range(len(by_index))]
+
+
+async def _download_preview(product):
+    """Download the preview image of a product unless it already exists.
+
+    Parameters
+    ----------
+    product : dict
+        The search result.
+
+    Returns
+    -------
+    str or None
+        The local path of the preview image, or None if it is not available.
+    """
+    path = os.path.join(CONFIG['GENERAL']['DATA_DIR'],
+                        product['filename'] + '.jpeg')
+    if os.path.isfile(path):
+        return path
+    url = product.get('preview')
+    if not url:
+        return None
+    server = _get_server_from_url(url)
+    if not await _server_available(server):
+        return None
+
+    try:
+        async with PREVIEW[server].get(url, timeout=_download_timeout()) \
+                as response:
+            _record_status(server, response.status)
+            if response.status != 200:
+                logger.info('Preview not available: {}'.format(
+                    product['filename']))
+                return None
+            data = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        BREAKERS[server].failure()
+        logger.info('Preview download failed: {} ({})'.format(
+            product['filename'], e))
+        return None
+
+    download_path = path + DOWNLOAD_SUFFIX
+    with open(download_path, 'wb') as f:
+        f.write(data)
+    os.replace(download_path, path)
+    return path
+
+
+async def _download_previews(products):
+    """Download the preview images of many products concurrently.
+
+    The number of simultaneous requests per server is limited by the
+    connection pool of `PREVIEW`.
+
+    Parameters
+    ----------
+    products : list of dict or async iterable
+        The search results.
+
+    Returns
+    -------
+    list
+        The local paths of the preview images (None if not available).
+    """
+    results = []
+
+    async def _indexed():
+        async for product in _aiter(products):
+            if type(product) is dict:
+                results.append(None)
+                yield len(results) - 1, product
+
+    async def _fetch(item):
+        index, product = item
+        try:
+            results[index] = await _download_preview(product)
+        except Exception as e:
+            logger.error('Preview download failed: {} ({})'.format(
+                product['filename'], e))
+
+    await _for_each(_indexed(), _fetch,
+                    CONFIG['GENERAL'].get('N_PREVIEWS', 4))
+    return results
+
+
+def download_previews(products):
+    """Download the preview images of a list of search results to
+    CONFIG['GENERAL']['DATA_DIR']. Existing images are skipped.
+
+    Parameters
+    ----------
+    products : list of dict
+        The search results.
+
+    Returns
+    -------
+    list
+        The local paths of the preview images (None if not available).
+    """
+    return block(_download_previews, products)
+
+
 def download(product):
+    """Download satellite products into CONFIG['GENERAL']['DATA_DIR'].
+
+    Parameters
+    ----------
+    product : str, dict, list or async iterable
+        A product name or search result, or many of them. If an async
+        iterable is given (e.g. `_iter_search`), the downloads start as the
+        products arrive.
+
+    Returns
+    -------
+    str or list
+        The local file path (False if the download failed, None if it was
+        skipped), or a list of (path, md5) tuples for multiple products.
+    """
     cont = CONFIG['GENERAL']['CONTINUE']
-    if isinstance(product, list):
+    preview = CONFIG['GENERAL']['DOWNLOAD_PREVIEW']
+    if isinstance(product, list) or hasattr(product, '__aiter__'):
         # Multiple downloads
         # tty.screen.status(total=len(product))
-        tasks = [_single_download(p, return_md5=True, cont=cont)
-                 for p in product]
-        loop = asyncio.get_event_loop()
-        result = loop.run_until_complete(asyncio.gather(*tasks))
+        async def _worker(p, slot=None):
+            return await _single_download(p, return_md5=True, cont=cont,
+                                          slot=slot)
+
+        jrnl = journal.open_journal()
+        if jrnl is not None and isinstance(product, list):
+            jrnl.queue(product)
+
+        async def _run(products):
+            keys = []
+            feeds = []
+
+            def _feed():
+                # A copy of the product stream for a background task. The
+                # downloads don't run further ahead of the task than this.
+                queue = asyncio.Queue(maxsize=CONFIG['GENERAL']['ENTRIES'])
+                feeds.append(queue)
+
+                async def _consume():
+                    while True:
+                        p = await queue.get()
+                        if p is None:
+                            return
+                        yield p
+                return _consume()
+
+            async def _tracked(stream):
+                try:
+                    async for p in stream:
+                        keys.append(_md5_key(p))
+                        if jrnl is not None:
+                            jrnl.queue([p])
+                        for queue in feeds:
+                            await queue.put(p)
+                        yield p
+                finally:
+                    for queue in feeds:
+                        await queue.put(None)
+
+            if isinstance(products, list):
+                keys = list(map(_md5_key, products))
+                feed = lambda: products  # noqa: E731
+            else:
+                feed = _feed
+                products = _tracked(products)
+            #
+            # Resolve the remote checksums alongside the downloads.
+            #
+            prefetch = asyncio.ensure_future(_prefetch_md5(feed()))
+            if preview:
+                previews = asyncio.ensure_future(_download_previews(feed()))
+            try:
+                return await DownloadScheduler().run(products, _worker,
+                                                     pass_slot=True)
+            finally:
+                prefetch.cancel()
+                for key in keys:
+                    _MD5_PREFETCH.pop(key, None)
+                if preview:
+                    await previews
+
+        result = block(_run, product)
     else:
         # Single download
         result = block(_single_download, product=product, cont=cont)
+        if preview and type(product) is dict:
+            download_previews([product])
 
     return result
 
 
-async def _single_download(product, return_md5=False, cont=True):
+async def _stream_to_s3(url, writer, pbar):
+    """Stream a remote file into an `s3.S3Writer`.
+
+    Returns
+    -------
+    bool
+        True if the file was received completely, False otherwise.
+    """
+    server = _get_server_from_url(url)
+    await _check_available(server)
+    try:
+        async with LIMITS[server], \
+                DOWNLOAD[server].get(url, timeout=_download_timeout()) \
+                as response:
+            _check_busy(server, response)
+            _record_status(server, response.status)
+            if response.status != 200:
+                return False
+            pbar.total = response.content_length
+            pbar.refresh()
+            await _receive(response, writer, server, pbar)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ServerBusyError) as e:
+        BREAKERS[server].failure()
+        logger.debug('Streaming {} failed: {}'.format(url, e))
+        return False
+    return True
+
+
+async def _download_to_s3(product, bucket, key=None, client=None):
+    """Download a satellite product directly into an S3 bucket.
+
+    Parameters
+    ----------
+    product : dict
+        A search result.
+    bucket : str
+        The target bucket.
+    key : str, optional
+        The target object key (default: the file name of the product).
+    client : botocore.client.S3, optional
+        The S3 client (default: `s3.get_client()`).
+
+    Returns
+    -------
+    str or bool
+        The URL of the object if the upload was successful and both the md5
+        checksum and the etag have been verified. False otherwise.
+    """
+    satellite = utils.get_satellite(product['filename'])
+    file_name = product['filename'] + CONFIG['SATELLITES'][satellite]['ext']
+    if key is None:
+        key = file_name
+    if client is None:
+        client = s3.get_client()
+    pbar = tty.screen[file_name]
+
+    for i in range(CONFIG['GENERAL']['TRIALS']):
+        for mirror in _rank_mirrors(product):
+            hash_md5 = hashlib.md5()
+            writer = s3.S3Writer(bucket, key, client=client,
+                                 hash_md5=hash_md5)
+            try:
+                if not await _stream_to_s3(mirror['url'], writer, pbar):
+                    await writer.abort()
+                    continue
+                remote_md5 = await _md5(product)
+                if hash_md5.hexdigest().lower() != remote_md5:
+                    logger.debug('{} MD5 checksum failed, trial {:d}/{:d}.'
+                                 .format(file_name, i+1,
+                                         CONFIG['GENERAL']['TRIALS']))
+                    await writer.abort()
+                    continue
+                await writer.complete()
+            except s3.ETagMismatchError as e:
+                logger.debug('{} {}'.format(file_name, e))
+                continue
+            except BaseException:
+                await writer.abort()
+                raise
+            tty.screen[file_name] = (tty.success('Successful') + ': {name}',
+                                     tty.NOBAR)
+            return 's3://{}/{}'.format(bucket, key)
+        await asyncio.sleep(CONFIG['GENERAL']['RECONNECT_TIME'])
+
+    logger.error('Upload failed: {}'.format(file_name))
+    tty.screen[file_name] = (tty.error('Failed') + ': {name}', tty.NOBAR)
+    return False
+
+
+def download_to_s3(product, bucket, key=None):
+    """Download satellite products directly into an S3 compatible object
+    store, without writing them to the local disk.
+
+    The etag of each object is computed while streaming and compared to the
+    one reported by the object store (see `checksum.etag`).
+
+    Parameters
+    ----------
+    product : dict or list of dict
+        One or more search results.
+    bucket : str
+        The target bucket.
+    key : str, optional
+        The object key of a single product (default: the file name).
+        Ignored if `product` is a list.
+
+    Returns
+    -------
+    str or bool or list
+        The URL of each uploaded object, or False if the upload failed.
+    """
+    client = s3.get_client()
+    if isinstance(product, list):
+        async def _worker(p):
+            return await _download_to_s3(p, bucket, client=client)
+        return block(DownloadScheduler().run, product, _worker)
+    return block(_download_to_s3, product, bucket, key=key, client=client)
+
+
+async def _try_download(url, destination, return_md5=False, cont=True,
+                        wait=True):
+    """Call `_download`, treating connection errors as a failed download.
+
+    If the server is busy (HTTP 503/429) and
+    `CONFIG['GENERAL']['WAIT_ON_503']` is set, wait for
+    `CONFIG['GENERAL']['RECONNECT_TIME']` seconds and try again
+    indefinitely.
+
+    If the circuit breaker of the server is open and `wait` is True, wait
+    until the server may be probed again instead of failing immediately.
+    """
+    failed = (False, None) if return_md5 else False
+    server = _get_server_from_url(url)
+    breaker = BREAKERS[server]
+    if not await _server_available(server):
+        if not wait:
+            return failed
+        await asyncio.sleep(max(breaker.retry_in(), 1.0))
+        if not await _server_available(server):
+            return failed
+
+    while True:
+        try:
+            with metrics.LATENCY.time(operation='download', server=server):
+                result = await _download(url, destination,
+                                         return_md5=return_md5, cont=cont)
+        except ServerBusyError as e:
+            logger.debug('{}: {}'.format(destination, e))
+            breaker.failure()
+            if not CONFIG['GENERAL']['WAIT_ON_503']:
+                return failed
+            metrics.RETRIES.inc(server=server)
+            await asyncio.sleep(max(breaker.retry_in(),
+                                    CONFIG['GENERAL']['RECONNECT_TIME']))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug('{}: {}'.format(destination, e))
+            breaker.failure()
+            return failed
+        else:
+            if (result[0] if return_md5 else result):
+                breaker.success()
+            return result
+
+
+# Process pool for the verification of downloaded files
+_VERIFY_POOL = None
+
+
+def _verify_executor():
+    """Return the executor used to verify downloaded files.
+
+    This is a process pool with CONFIG['GENERAL']['VERIFY_PROCESSES']
+    workers (default: the number of CPUs), or the default thread pool of the
+    event loop if set to 0.
+    """
+    global _VERIFY_POOL
+    processes = CONFIG['GENERAL'].get('VERIFY_PROCESSES')
+    if processes == 0:
+        return None
+    if _VERIFY_POOL is None:
+        _VERIFY_POOL = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes)
+    return _VERIFY_POOL
+
+
+def _shutdown_verify_executor():
+    """Shut down the process pool of `_verify_executor`, if any."""
+    global _VERIFY_POOL
+    if _VERIFY_POOL is not None:
+        _VERIFY_POOL.shutdown()
+        _VERIFY_POOL = None
+
+
+async def _verify(path, compute_md5=True, check_zip=False):
+    """Run `checksum.verify` on a file without blocking the event loop.
+
+    Returns
+    -------
+    tuple (str, bool)
+        The md5 checksum (None if not computed) and whether the file is a
+        valid zip archive.
+    """
+    global _VERIFY_POOL
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(_verify_executor(), checksum.verify,
+                                          path, compute_md5, check_zip)
+    except concurrent.futures.process.BrokenProcessPool:
+        logger.warning('Verification process pool broken, using threads.')
+        _VERIFY_POOL = None
+        return await loop.run_in_executor(None, checksum.verify,
+                                          path, compute_md5, check_zip)
+
+
+def _is_archive(filename):
+    return any(filename.endswith(ext) for _, exts, _ in
+               shutil.get_unpack_formats() for ext in exts)
+
+
+async def _extract(archive, extracted_path):
+    """Extract a verified archive in the verification process pool.
+
+    The archive is deleted afterwards unless
+    CONFIG['GENERAL']['KEEP_ARCHIVE'] is set.
+
+    Returns
+    -------
+    str or bool
+        `extracted_path` if the archive contained it, False otherwise.
+    """
+    loop = asyncio.get_event_loop()
+    keep = CONFIG['GENERAL'].get('KEEP_ARCHIVE', True)
+    try:
+        paths = await loop.run_in_executor(
+            _verify_executor(), utils.extract, archive, None, False)
+    except Exception as e:
+        logger.error('Extraction of {} failed: {}'.format(archive, e))
+        return False
+    if os.path.abspath(extracted_path) not in map(os.path.abspath, paths):
+        logger.error('{} does not contain {}'.format(
+            archive, os.path.basename(extracted_path)))
+        return False
+    if not keep:
+        os.remove(archive)
+    return extracted_path
+
+
+async def _single_download(product, return_md5=False, cont=True, slot=None):
     """Download a satellite product.
 
-    Checks for file existence and MD5 checksum.
+    Checks for file existence and MD5 checksum. A completed download is
+    verified in a separate process and only renamed to its final name once
+    it has passed. If another process is already downloading the product,
+    wait for it or skip the product, depending on
+    CONFIG['GENERAL']['LOCKED_DOWNLOADS'].
 
     Parameters
     ----------
@@ -743,12 +2547,16 @@ async def _single_download(product, return_md5=False, cont=True):
         Whether to compute and return the md5 hash sum (default: False).
     cont : bool, optional
         Continue partial downloads (default: True).
+    slot : _Slot, optional
+        The scheduler slot of the download. It is released while the
+        download is verified, so that the next download can start.
 
     Returns
     -------
     str
         The local file path if the download was successful OR the file already
-        exists and passes the md5 checksum test. False otherwise.
+        exists and passes the md5 checksum test. None if the download was
+        skipped, False otherwise.
     """
     if type(product) is dict:
         fdata = product
@@ -758,6 +2566,42 @@ async def _single_download(product, return_md5=False, cont=True):
         )
         fdata = fdata[0]
 
+    satellite = utils.get_satellite(fdata['filename'])
+    file_name = fdata['filename'] + CONFIG['SATELLITES'][satellite]['ext']
+    download_path = os.path.join(CONFIG['GENERAL']['DATA_DIR'],
+                                 file_name + DOWNLOAD_SUFFIX)
+
+    #
+    # Make sure that no other process is downloading the same product.
+    #
+    lock = FileLock(download_path)
+    wait = CONFIG['GENERAL'].get('LOCKED_DOWNLOADS', 'wait') == 'wait'
+    if not lock.try_acquire():
+        if not wait:
+            msg = '{} Skipping (downloaded by another process)'.format(
+                file_name)
+            logger.debug(msg)
+            tty.screen[file_name] = (tty.warn('Skipping') + ': {name}',
+                                     tty.NOBAR)
+            return None
+        logger.debug('{} Waiting for another process'.format(file_name))
+        tty.screen[file_name] = (tty.warn('Waiting') + ': {name}',
+                                 tty.NOBAR)
+        if slot is not None:
+            slot.release()
+        await lock.acquire()
+    try:
+        return await _locked_download(fdata, return_md5=return_md5,
+                                      cont=cont, slot=slot)
+    finally:
+        lock.release()
+
+
+async def _locked_download(fdata, return_md5=False, cont=True, slot=None):
+    """Download a satellite product while holding its `FileLock`.
+
+    See `_single_download`.
+    """
     satellite = utils.get_satellite(fdata['filename'])
     ext = CONFIG['SATELLITES'][satellite]['ext']
     file_name = fdata['filename'] + ext
@@ -770,13 +2614,51 @@ async def _single_download(product, return_md5=False, cont=True):
 
     full_file_path = os.path.join(CONFIG['GENERAL']['DATA_DIR'], file_name)
     download_path = full_file_path + DOWNLOAD_SUFFIX
+    jrnl = journal.open_journal()
+    extract = CONFIG['GENERAL'].get('EXTRACT', False) and \
+        _is_archive(file_name) and CONFIG['SATELLITES'][satellite]['suffix']
+    extracted_path = os.path.join(
+        CONFIG['GENERAL']['DATA_DIR'],
+        fdata['filename'] + CONFIG['SATELLITES'][satellite]['suffix'])
 
     #
     # Check if file already exists in location:
     #
-    if os.path.exists(full_file_path) and os.path.isfile(full_file_path):
+    if extract and os.path.isdir(extracted_path) and \
+            not os.path.exists(full_file_path):
+        #
+        # The product has been extracted and the archive deleted.
+        #
+        entry = jrnl.get(fdata['filename']) if jrnl is not None else None
+        local_md5 = entry['md5'] if entry is not None else None
+        full_file_path = extracted_path
+        msg = '{} Skipping download (extracted)'.format(file_name)
+        tty.screen[pbar_key] = (tty.success('Exists') + ': {name}',
+                                tty.NOBAR)
+        logger.debug(msg)
+        b_download = False
+        b_file_okay = True
+
+    elif os.path.exists(full_file_path) and os.path.isfile(full_file_path):
+        verified_md5 = None
+        if jrnl is not None:
+            verified_md5 = jrnl.is_verified(fdata['filename'], full_file_path)
 
-        if not CONFIG['GENERAL']['CHECK_EXISTING']:
+        if verified_md5 is not None:
+            #
+            # File exists and has been verified before.
+            #
+            local_md5 = verified_md5
+            file_size = os.path.getsize(full_file_path)
+            msg = '{} Skipping download (verified)'.format(file_name)
+            tty.screen[pbar_key] = (tty.success('Exists') + ': {name}',
+                                    tty.NOBAR)
+            tty.screen.status(progress=file_size)
+            logger.debug(msg)
+            b_download = False
+            b_file_okay = True
+
+        elif not CONFIG['GENERAL']['CHECK_EXISTING']:
             #
             # File exists and won't be checked.
             #
@@ -790,7 +2672,7 @@ async def _single_download(product, return_md5=False, cont=True):
             #
             # File exists and will be checked for md5 consistency
             #
-            local_md5 = checksum.md5(full_file_path)
+            local_md5, _ = await _verify(full_file_path)
             remote_md5 = await _md5(fdata)
             if local_md5 == remote_md5:
                 file_size = os.path.getsize(full_file_path)
@@ -801,6 +2683,9 @@ async def _single_download(product, return_md5=False, cont=True):
                 logger.debug(msg)
                 b_download = False
                 b_file_okay = True
+                if jrnl is not None:
+                    jrnl.update(fdata['filename'], journal.VERIFIED,
+                                md5=local_md5, path=full_file_path)
 
             else:
                 msg = '{} MD5 wrong: redownloading ...'.format(file_name)
@@ -811,11 +2696,43 @@ async def _single_download(product, return_md5=False, cont=True):
         #
         # Retrials in case the MD5 hashsum fails
         #
+        check_zip = CONFIG['GENERAL'].get('VERIFY_ZIP', False) and \
+            ext == '.zip'
+        #
+        # The transfer may have been completed by an earlier run that was
+        # interrupted before the file was verified.
+        #
+        transferred = cont and jrnl is not None and \
+            jrnl.is_downloaded(fdata['filename'], download_path)
         for i in range(CONFIG['GENERAL']['TRIALS']):
-            complete = await _download(fdata['url'], download_path,
-                                       return_md5=return_md5, cont=cont)
-            if return_md5:
-                complete, local_md5 = complete
+            if slot is not None:
+                await slot.acquire()
+            if transferred:
+                logger.debug('{} Verifying earlier download'.format(
+                    file_name))
+                server = _get_server_from_url(fdata['url'])
+                complete, local_md5 = True, None
+                transferred = False
+            else:
+                #
+                # Start with the fastest mirror. If the transfer fails or
+                # stalls, continue the partial download from the next one.
+                #
+                mirrors = _rank_mirrors(fdata)
+                for n, mirror in enumerate(mirrors):
+                    server = _get_server_from_url(mirror['url'])
+                    complete = await _try_download(
+                        mirror['url'], download_path, return_md5=return_md5,
+                        cont=cont or n > 0, wait=n + 1 == len(mirrors))
+                    if (complete[0] if return_md5 else complete) or \
+                            n + 1 == len(mirrors):
+                        break
+                    logger.debug('{} Switching to mirror {}'.format(
+                        file_name, mirrors[n + 1]['host']))
+                if return_md5:
+                    complete, local_md5 = complete
+                else:
+                    local_md5 = None
 
             #
             # After download, check MD5 hashsum
@@ -829,23 +2746,52 @@ async def _single_download(product, return_md5=False, cont=True):
                 logger.debug(msg)
                 tty.screen[pbar_key] = (tty.error('Failed') + ': {name}',
                                         tty.NOBAR)
+                if jrnl is not None and os.path.isfile(download_path):
+                    jrnl.update(fdata['filename'], journal.PARTIAL,
+                                offset=_read_progress(download_path))
+                metrics.RETRIES.inc(server=server)
+                await asyncio.sleep(CONFIG['GENERAL']['RECONNECT_TIME'])
             else:
                 #
                 # Download completed.
                 #
-                if not return_md5:
-                    local_md5 = checksum.md5(download_path)
+                if jrnl is not None:
+                    jrnl.update(fdata['filename'], journal.DOWNLOADED,
+                                path=download_path)
+                #
+                # Verify the file in a separate process and let the next
+                # download start in the meantime.
+                #
+                if slot is not None:
+                    slot.release()
+                if local_md5 is None or check_zip:
+                    computed_md5, valid = await _verify(
+                        download_path, compute_md5=local_md5 is None,
+                        check_zip=check_zip)
+                    if local_md5 is None:
+                        local_md5 = computed_md5
+                else:
+                    valid = True
 
-                remote_md5 = await _md5(fdata)
-                if local_md5 != remote_md5:
+                remote_md5 = await _md5_after_transfer(fdata)
+                if not valid or local_md5 != remote_md5:
                     #
-                    # Download failed.
+                    # Download failed. Discard the file, so that the next
+                    # trial starts from scratch.
                     #
-                    msg = '{} MD5 checksum failed, trial {:d}/{:d}.'.format(
-                            file_name, i+1, CONFIG['GENERAL']['TRIALS'])
+                    check_name = 'MD5 checksum' if valid else 'Zip check'
+                    msg = '{} {} failed, trial {:d}/{:d}.'.format(
+                            file_name, check_name, i+1,
+                            CONFIG['GENERAL']['TRIALS'])
                     logger.debug(msg)
                     tty.screen[pbar_key] = (tty.error('Failed') + ': {name}',
                                             tty.NOBAR)
+                    if valid:
+                        metrics.CHECKSUM_FAILURES.inc(server=server)
+                    metrics.RETRIES.inc(server=server)
+                    _remove_progress(download_path)
+                    if os.path.isfile(download_path):
+                        os.remove(download_path)
                 else:
                     #
                     # Download completed and successful.
@@ -860,26 +2806,31 @@ async def _single_download(product, return_md5=False, cont=True):
         if not b_file_okay:
             msg = '{} Download failed.'.format(file_name)
             logger.warning(msg)
+            if jrnl is not None:
+                jrnl.update(fdata['filename'], journal.FAILED)
             tty.screen[pbar_key] = (tty.error('Failed') + ': {name}',
                                     tty.NOBAR)
 
-    if CONFIG['GENERAL']['DOWNLOAD_PREVIEW']:
-        full_preview_path = os.path.join(CONFIG['GENERAL']['DATA_DIR'],
-                                         fdata['filename']+'.jpeg')
-        #
-        # If not yet done, download preview file
-        #
-        if not os.path.exists(full_preview_path) or \
-                not os.path.isfile(full_preview_path):
-            if not _download(fdata['preview'], full_preview_path):
-                logger.info('  Preview not available.')
-
     if b_file_okay:
         #
         # File has been downloaded successfully OR already exists
         # --> Return the file path
         #
-        os.rename(download_path, full_file_path)
+        if b_download:
+            os.rename(download_path, full_file_path)
+            _remove_progress(download_path)
+            if jrnl is not None:
+                jrnl.update(fdata['filename'], journal.VERIFIED,
+                            md5=local_md5, path=full_file_path)
+        if extract and os.path.isfile(full_file_path) and \
+                not os.path.isdir(extracted_path):
+            tty.screen[pbar_key] = (tty.warn('Extracting') + ': {name}',
+                                    tty.NOBAR)
+            full_file_path = await _extract(full_file_path, extracted_path)
+            if not full_file_path:
+                tty.screen[pbar_key] = (tty.error('Extraction failed') +
+                                        ': {name}', tty.NOBAR)
+                return False
         msg = 'Download successful: {}'.format(full_file_path)
         logger.debug(msg)
         tty.screen[pbar_key] = (tty.success('Successful') + ': {name}',
@@ -901,9 +2852,9 @@ async def _single_download(product, return_md5=False, cont=True):
 
     else:
         #
-        # File download was skipped --> Return FALSE
+        # File download was skipped --> Return NONE
         #
-        return False
+        return None
 
 
 async def _get_remote_files_per_satellite(files, satellite):
@@ -41,9 +41,9 @@ def prepare():
     config.CONFIG['GENERAL']['DATA_DIR'] = TEST_DATA_DIR_ORIGINAL
     scihub.download(fs)
     # move and corrupt one of the files
-    corrupt_file = os.listdir(TEST_DATA_DIR_ORIGINAL)[-1]
-    _move_from = os.path.join(TEST_DATA_DIR_ORIGINAL, corrupt_file)
-    _move_to = os.path.join(TEST_DATA_DIR_CORRUPT, corrupt_file)
+    _move_from = utils.ls(TEST_DATA_DIR_ORIGINAL)[-1]
+    _move_to = os.path.join(TEST_DATA_DIR_CORRUPT,
+                            os.path.split(_move_from)[1])
     shutil.move(_move_from, _move_to)
     _corrupt_binary(_move_to)
     config.CONFIG['GENERAL']['DATA_DIR'] = _config
@@ -72,6 +72,11 @@ def set_test_config():
     config.CONFIG['GENERAL']['RECONNECT_TIME'] = 0.0
     config.CONFIG['GENERAL']['TRIALS'] = 3
     config.CONFIG['GENERAL']['WAIT_ON_503'] = False
+    # Always query the servers
+    config.CONFIG['GENERAL']['QUERY_CACHE'] = False
+    # Don't write any state into the test data or the home directory
+    config.CONFIG['GENERAL']['JOURNAL'] = False
+    config.CONFIG['GENERAL']['CHECKSUM_CACHE'] = False
 
 
 def copy_test_data():
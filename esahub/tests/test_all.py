@@ -1,4 +1,5 @@
-from esahub import scihub, utils, checksum, check, main
+from esahub import scihub, utils, geo, checksum, check, main, throttle, \
+    journal, cache, s3, metrics
 import unittest
 import contextlib
 import logging
@@ -8,6 +9,16 @@ import pytz
 import os
 import sys
 import subprocess
+import hashlib
+import asyncio
+import aiohttp
+import io
+import tempfile
+import zipfile
+import pickle
+from urllib.parse import urlparse, parse_qs
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from shapely.wkt import loads as wkt_loads
 from esahub.tests import config as test_config
 from esahub import config
@@ -125,6 +136,282 @@ class ScihubTestCase(TestCase):
                     scihub._auto_detect_server_from_query(query), server
                 )
 
+    def test__merge_mirrors(self):
+        results = [
+            {'filename': 'A', 'url': 'u1', 'host': 'h1', 'uuid': '1'},
+            {'filename': 'B', 'url': 'u2', 'host': 'h1', 'uuid': '2'},
+            {'filename': 'A', 'url': 'u3', 'host': 'h2', 'uuid': '3'},
+        ]
+        merged = scihub._merge_mirrors(results)
+        #
+        # Assert that the first result of each product is kept and that all
+        # download locations are collected.
+        #
+        self.assertEqual([p['filename'] for p in merged], ['A', 'B'])
+        self.assertEqual(merged[0]['url'], 'u1')
+        self.assertEqual([m['url'] for m in merged[0]['mirrors']],
+                         ['u1', 'u3'])
+        self.assertEqual(len(merged[1]['mirrors']), 1)
+
+    def test__md5_prefetched(self):
+        product = {'filename': 'A', 'host': 'h1', 'uuid': '1'}
+
+        async def _prefetched():
+            future = asyncio.get_event_loop().create_future()
+            future.set_result('0123456789abcdef')
+            scihub._MD5_PREFETCH[scihub._md5_key(product)] = future
+            try:
+                return await scihub._md5(product)
+            finally:
+                scihub._MD5_PREFETCH.clear()
+
+        #
+        # Assert that a prefetched checksum is used without a request.
+        #
+        self.assertEqual(scihub.block(_prefetched), '0123456789abcdef')
+
+    def test__iter_file_list_from_url_window(self):
+        url = 'https://example.com/dhus/search?q=*&start=0&rows=10'
+        in_flight = []
+        max_in_flight = []
+
+        async def _first_page(url, verbose=False):
+            return 95, await _page(url)
+
+        async def _page(url, verbose=False):
+            in_flight.append(url)
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(url)
+            start = int(parse_qs(urlparse(url).query)['start'][0])
+            return [{'filename': str(i)} for i in range(start, start + 10)]
+
+        first_page_from_url = scihub._first_page_from_url
+        files_from_url = scihub._files_from_url
+        scihub._first_page_from_url = _first_page
+        scihub._files_from_url = _page
+        config.CONFIG['GENERAL']['PAGE_WINDOW'] = 3
+        try:
+            result = scihub.block(scihub._get_file_list_from_url, url,
+                                  limit=95)
+        finally:
+            scihub._first_page_from_url = first_page_from_url
+            scihub._files_from_url = files_from_url
+            config.CONFIG['GENERAL']['PAGE_WINDOW'] = None
+        #
+        # Assert that all pages are returned in order, with at most
+        # PAGE_WINDOW requests at the same time.
+        #
+        self.assertEqual([p['filename'] for p in result],
+                         [str(i) for i in range(95)])
+        self.assertLessEqual(max(max_in_flight), 3)
+
+    def test__iter_file_list_from_url_single_request(self):
+        url = 'https://example.com/dhus/search?q=*&start=0&rows=100'
+        requests = []
+
+        async def _resolve(url, *args, **kwargs):
+            requests.append(url)
+            return ('<feed xmlns="http://www.w3.org/2005/Atom" '
+                    'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+                    '<opensearch:totalResults>250</opensearch:totalResults>'
+                    '</feed>')
+
+        resolve = scihub._resolve
+        scihub._resolve = _resolve
+        try:
+            scihub.block(scihub._get_file_list_from_url, url, limit=2)
+        finally:
+            scihub._resolve = resolve
+        #
+        # Assert that the first page is only requested once, and that no
+        # more rows are requested than needed.
+        #
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(parse_qs(urlparse(requests[0]).query)['rows'],
+                         ['2'])
+
+    def test_search_fails(self):
+        async def _failing(url, *args, **kwargs):
+            raise aiohttp.ClientConnectionError('unreachable')
+            yield
+
+        iter_file_list = scihub._iter_file_list_from_url
+        scihub._iter_file_list_from_url = _failing
+        try:
+            with self.assertRaises(aiohttp.ClientConnectionError):
+                scihub.search({'mission': 'Sentinel-1'}, server='all')
+        finally:
+            scihub._iter_file_list_from_url = iter_file_list
+
+    def test_search_partly_fails(self):
+        urls = []
+
+        async def _partly_failing(url, *args, **kwargs):
+            urls.append(url)
+            host = _get_host(url)
+            yield {'filename': 'S1A_' + host, 'url': url, 'host': host,
+                   'uuid': host}
+            if 's5phub' in url:
+                raise aiohttp.ClientConnectionError('unreachable')
+
+        _get_host = scihub._get_host_from_url
+        iter_file_list = scihub._iter_file_list_from_url
+        scihub._iter_file_list_from_url = _partly_failing
+        try:
+            with self.assertLogs(level='WARNING') as logs:
+                results = scihub.search({'mission': 'Sentinel-1'},
+                                        server='all')
+        finally:
+            scihub._iter_file_list_from_url = iter_file_list
+        #
+        # Assert that the results of the other servers are returned, and
+        # that the failure is logged.
+        #
+        self.assertEqual(len(results), len(urls))
+        self.assertIn('S5P', '\n'.join(logs.output))
+
+    def test_parse_page(self):
+        link = "https://scihub.copernicus.eu/dhus/odata/v1/Products('{}')/"
+        entry = (
+            '<entry><title>{name}</title>'
+            '<link href="{link}$value"/>'
+            '<link rel="icon" href="{link}Products(\'Quicklook\')/$value"/>'
+            '<id>{uuid}</id>'
+            '<date name="ingestiondate">{date}</date>'
+            '<int name="relativeorbitnumber">117</int>'
+            '{footprint}'
+            '<str name="size">{size}</str>'
+            '<str name="orbitdirection">{direction}</str>'
+            '<str name="identifier">{name}</str></entry>')
+        footprint = (
+            '<str name="gmlfootprint">&lt;gml:Polygon&gt;&lt;gml:coordinates'
+            '&gt;53.1,-8.2 53.6,-6.1 55.0,-6.5 53.1,-8.2&lt;/gml:coordinates'
+            '&gt;&lt;/gml:Polygon&gt;</str>')
+        xml = (
+            '<feed xmlns="http://www.w3.org/2005/Atom" '
+            'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+            '<opensearch:totalResults>2</opensearch:totalResults>'
+            + entry.format(name='S1A_A', uuid='1', link=link.format('1'),
+                           date='2018-06-01T10:15:30.123Z', size='1.5 GB',
+                           footprint=footprint, direction='ascending')
+            + entry.format(name='S1A_B', uuid='2', link=link.format('2'),
+                           date='2018-06-02T00:00:00Z', size='800 MB',
+                           footprint='', direction='')
+            + '</feed>').encode('utf-8')
+        result = scihub.parse_page(xml)
+        #
+        # Assert that all fields are extracted, and that the fixed-format
+        # dates match the general date parser.
+        #
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0]['filename'], 'S1A_A')
+        self.assertEqual(result[0]['url'], link.format('1') + '$value')
+        self.assertEqual(result[0]['preview'],
+                         link.format('1') + "Products('Quicklook')/$value")
+        self.assertEqual(result[0]['host'],
+                         'https://scihub.copernicus.eu/dhus')
+        self.assertEqual(result[0]['size'], 1.5 * 1024**3)
+        self.assertEqual(result[0]['rel_orbit'], 117)
+        self.assertEqual(result[0]['orbit_direction'], 'ASCENDING')
+        self.assertIsNone(result[1]['orbit_direction'])
+        self.assertEqual(result[0]['ingestiondate'], utils.to_date(
+            '2018-06-01T10:15:30.123Z', output='date'))
+        self.assertEqual(result[1]['ingestiondate'], utils.to_date(
+            '2018-06-02T00:00:00Z', output='date'))
+        self.assertEqual(result[0]['coords'], geo.gml_to_polygon(
+            '53.1,-8.2 53.6,-6.1 55.0,-6.5 53.1,-8.2'))
+        self.assertIsNone(result[1]['coords'])
+        self.assertEqual(scihub.parse_page(b'<feed'), [])
+
+    def test__download_previews_existing(self):
+        _data_dir = config.CONFIG['GENERAL']['DATA_DIR']
+        config.CONFIG['GENERAL']['DATA_DIR'] = tempfile.mkdtemp()
+        try:
+            path = os.path.join(config.CONFIG['GENERAL']['DATA_DIR'],
+                                'A.jpeg')
+            with open(path, 'wb') as f:
+                f.write(b'jpeg')
+            products = [{'filename': 'A', 'preview': 'http://invalid/A'},
+                        {'filename': 'B'}]
+            #
+            # Assert that existing previews are not downloaded again.
+            #
+            self.assertEqual(scihub.download_previews(products), [path, None])
+        finally:
+            config.CONFIG['GENERAL']['DATA_DIR'] = _data_dir
+
+    def test_session_manager(self):
+        server = list(config.CONFIG['SERVERS'])[0]
+
+        async def _sessions():
+            async with scihub.SessionManager(concurrent=2) as manager:
+                first = manager[server]
+                reused = manager[server] is first
+            closed = first.closed
+            await first.close()
+            recreated = manager[server]
+            await manager.close()
+            return reused, closed, recreated is not first
+
+        #
+        # Assert that a session is reused, closed by the context manager and
+        # recreated when needed.
+        #
+        self.assertEqual(scihub.block(_sessions), (True, True, True))
+
+    def test_session_manager_loops(self):
+        server = list(config.CONFIG['SERVERS'])[0]
+        manager = scihub.SessionManager()
+
+        async def _session():
+            return manager[server]
+
+        loops = [asyncio.new_event_loop() for _ in range(2)]
+        try:
+            sessions = [loop.run_until_complete(_session())
+                        for loop in loops]
+            self.assertIsNot(sessions[0], sessions[1])
+            manager.close_idle()
+            #
+            # Assert that the sessions of both loops are closed.
+            #
+            self.assertTrue(all(session.closed for session in sessions))
+        finally:
+            for loop in loops:
+                loop.close()
+
+    def test_close_sessions(self):
+        path = os.path.join(tempfile.mkdtemp(), 'file')
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        md5, _ = scihub.block(scihub._verify, path)
+        self.assertEqual(md5, hashlib.md5(b'data').hexdigest())
+        processes = list(scihub._verify_executor()._processes.values())
+        scihub.close_sessions()
+        #
+        # Assert that the verification processes are shut down.
+        #
+        self.assertIsNone(scihub._VERIFY_POOL)
+        self.assertTrue(processes)
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+    def test_file_lock(self):
+        # The directory doesn't exist yet.
+        path = os.path.join(tempfile.mkdtemp(), 'data', 'product.zip.download')
+        first = scihub.FileLock(path)
+        second = scihub.FileLock(path)
+        #
+        # Assert that the lock is exclusive and that the lock file is
+        # removed once released.
+        #
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        first.release()
+        self.assertFalse(os.path.exists(first.path))
+        self.assertTrue(second.try_acquire())
+        second.release()
+
     def test__uuid_from_identifier(self):
         products = scihub.search({}, limit=1)
         for product in products:
@@ -385,6 +672,382 @@ class ScihubDownloadTestCase(TestCase):
                 self.assertTrue(healthy)
 
 
+class DownloadSchedulerTestCase(TestCase):
+
+    def _run(self, products, **kwargs):
+        scheduler = scihub.DownloadScheduler(**kwargs)
+        started = []
+        active = []
+        max_active = []
+
+        async def worker(product):
+            started.append(product['filename'])
+            active.append(product)
+            max_active.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(product)
+            return product['filename']
+
+        results = scihub.block(scheduler.run, products, worker)
+        return results, started, max(max_active)
+
+    def test_bounded_and_ordered(self):
+        products = [{'filename': 'f{}'.format(i), 'size': 10 - i,
+                     'host': 'h{}'.format(i % 2)} for i in range(10)]
+        results, started, max_active = self._run(products, order='smallest',
+                                                 active=3)
+        #
+        # Assert that the results are returned in input order, that at most
+        # `active` downloads ran at the same time and that the smallest
+        # products were started first.
+        #
+        self.assertEqual(results, [p['filename'] for p in products])
+        self.assertLessEqual(max_active, 3)
+        self.assertEqual(started, [p['filename'] for p in products[::-1]])
+
+    def test_early_release(self):
+        scheduler = scihub.DownloadScheduler(active=1)
+        events = []
+
+        async def worker(product, slot=None):
+            events.append('start ' + product)
+            await asyncio.sleep(0.01)
+            slot.release()
+            # Verification, while the next download is running
+            await asyncio.sleep(0.05)
+            events.append('end ' + product)
+            return product
+
+        results = scihub.block(scheduler.run, ['a', 'b'], worker,
+                               pass_slot=True)
+        #
+        # Assert that the next product starts as soon as the slot has been
+        # released.
+        #
+        self.assertEqual(results, ['a', 'b'])
+        self.assertEqual(events, ['start a', 'start b', 'end a', 'end b'])
+
+    def test_async_iterable(self):
+        products = [{'filename': 'f{}'.format(i), 'size': i}
+                    for i in range(5)]
+        arrived = []
+
+        async def stream():
+            for product in products:
+                await asyncio.sleep(0.02)
+                arrived.append(product['filename'])
+                yield product
+
+        results, started, max_active = self._run(stream(), active=2)
+        #
+        # Assert that all products are downloaded as they arrive, and that
+        # the results are returned in arrival order.
+        #
+        self.assertEqual(results, [p['filename'] for p in products])
+        self.assertEqual(started, arrived)
+        self.assertLessEqual(max_active, 2)
+
+    def test_round_robin(self):
+        products = [{'filename': 'a1', 'host': 'a'},
+                    {'filename': 'a2', 'host': 'a'},
+                    {'filename': 'b1', 'host': 'b'}]
+        _, started, _ = self._run(products, order='round-robin', active=1)
+        self.assertEqual(started, ['a1', 'b1', 'a2'])
+
+
+class LocalDownloadTestCase(TestCase):
+    """Downloads from a local HTTP server that supports Range requests."""
+    PAYLOAD = bytes(range(256)) * 4096
+
+    @classmethod
+    def setUpClass(cls):
+        test_config.set_test_config()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmp_dir, 'S1A_TEST.zip' +
+                                        scihub.DOWNLOAD_SUFFIX)
+        self.ranges = []
+        self.sizes = []
+        self.accept_ranges = True
+        self.fail_at = None
+        app = web.Application()
+        app.router.add_get('/dhus/product', self._handler)
+        app.router.add_get(
+            "/dhus/odata/v1/Products('{uuid}')/Checksum/Value/$value",
+            self._checksum)
+        self.server = TestServer(app)
+        scihub.block(self.server.start_server)
+        self.url = str(self.server.make_url('/dhus/product'))
+        self.general = config.CONFIG['GENERAL'].copy()
+        config.CONFIG['SERVERS']['LOCAL'] = {
+            'host': str(self.server.make_url('/dhus')),
+            'user': 'user', 'password': 'password', 'downloads': 4}
+
+    def tearDown(self):
+        scihub.close_sessions()
+        scihub.block(self.server.close)
+        del config.CONFIG['SERVERS']['LOCAL']
+        config.CONFIG['GENERAL'].clear()
+        config.CONFIG['GENERAL'].update(self.general)
+
+    async def _handler(self, request):
+        header = request.headers.get('Range')
+        self.ranges.append(header)
+        if os.path.isfile(self.destination):
+            self.sizes.append(os.path.getsize(self.destination))
+        if header is None or not self.accept_ranges:
+            return web.Response(body=self.PAYLOAD)
+        start, end = header[len('bytes='):].split('-')
+        start = int(start)
+        end = int(end) if end else len(self.PAYLOAD) - 1
+        if start >= len(self.PAYLOAD):
+            return web.Response(status=416, headers={
+                'Content-Range': 'bytes */{}'.format(len(self.PAYLOAD))})
+        headers = {'Content-Range': 'bytes {}-{}/{}'.format(
+            start, end, len(self.PAYLOAD))}
+        if self.fail_at is None:
+            return web.Response(status=206, body=self.PAYLOAD[start:end + 1],
+                                headers=headers)
+        # Send the ranges slowly, so that the others are still being
+        # received when the connection of `fail_at` is closed.
+        headers['Content-Length'] = str(end + 1 - start)
+        response = web.StreamResponse(status=206, headers=headers)
+        await response.prepare(request)
+        for offset in range(start, end + 1, 16384):
+            if start == self.fail_at and offset > start:
+                request.transport.close()
+                return response
+            await response.write(
+                self.PAYLOAD[offset:min(offset + 16384, end + 1)])
+            await asyncio.sleep(0.01)
+        return response
+
+    async def _checksum(self, request):
+        return web.Response(text=hashlib.md5(self.PAYLOAD).hexdigest())
+
+    def _product(self):
+        return {'filename': 'S1A_TEST', 'title': 'S1A_TEST', 'uuid': '1',
+                'url': self.url, 'host': str(self.server.make_url('/dhus')),
+                'size': len(self.PAYLOAD)}
+
+    def _assert_complete(self, result):
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), self.PAYLOAD)
+        self.assertEqual(result,
+                         (True, hashlib.md5(self.PAYLOAD).hexdigest()))
+        # The progress is kept until the file has been verified.
+        self.assertEqual(scihub._read_progress(self.destination),
+                         len(self.PAYLOAD))
+
+    def test_stream_writer(self):
+        chunks = [os.urandom(1000) for _ in range(50)]
+        data = b''.join(chunks)
+
+        async def _write(f):
+            progress = []
+            hash_md5 = hashlib.md5()
+            writer = scihub.StreamWriter(f, hash_md5=hash_md5, offset=10,
+                                         progress=progress.append,
+                                         maxsize=2)
+            for chunk in chunks:
+                await writer.write(chunk)
+            await writer.close()
+            return writer.written, hash_md5.hexdigest(), progress
+
+        path = os.path.join(self.tmp_dir, 'stream')
+        with open(path, 'wb', buffering=0) as f:
+            unbuffered = scihub.block(_write, f)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        buffered = io.BytesIO()
+        self.assertEqual(scihub.block(_write, buffered), unbuffered)
+        self.assertEqual(buffered.getvalue(), data)
+        #
+        # Assert that the offset is included in the number of bytes written
+        # and reported as progress, but not in the checksum.
+        #
+        written, md5, progress = unbuffered
+        self.assertEqual(written, len(data) + 10)
+        self.assertEqual(md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(progress[-1], written)
+
+    @unittest.skipIf(not hasattr(os, 'writev'), 'requires os.writev')
+    def test_write_buffers(self):
+        chunks = [b'abc', b'', b'defghijklmn', b'op', b'qrstuvwxyz']
+        path = os.path.join(self.tmp_dir, 'buffers')
+        writev = os.writev
+
+        def _short_writev(fd, buffers):
+            # Write at most 4 bytes per call.
+            return os.write(fd, b''.join(bytes(b) for b in buffers)[:4])
+
+        os.writev = _short_writev
+        try:
+            with open(path, 'wb', buffering=0) as f:
+                scihub._write_buffers(f, chunks)
+        finally:
+            os.writev = writev
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(chunks))
+
+    @unittest.skipIf(not hasattr(os, 'posix_fallocate'),
+                     'requires os.posix_fallocate')
+    def test_preallocate(self):
+        path = os.path.join(self.tmp_dir, 'preallocated')
+        config.CONFIG['GENERAL']['PREALLOCATE'] = False
+        with open(path, 'wb') as f:
+            self.assertFalse(scihub._preallocate(f, 10000))
+        self.assertEqual(os.path.getsize(path), 0)
+        config.CONFIG['GENERAL']['PREALLOCATE'] = True
+        with open(path, 'wb') as f:
+            allocated = scihub._preallocate(f, 10000)
+        if not allocated:
+            self.skipTest('preallocation not supported by the file system')
+        self.assertEqual(os.path.getsize(path), 10000)
+
+    def test_download_new_data_dir(self):
+        data_dir = os.path.join(self.tmp_dir, 'new')
+        config.CONFIG['GENERAL']['DATA_DIR'] = data_dir
+        config.CONFIG['GENERAL']['VERIFY_ZIP'] = False
+        #
+        # Assert that the data directory is created when needed, both for
+        # single and multiple downloads.
+        #
+        path = os.path.join(data_dir, 'S1A_TEST.zip')
+        self.assertEqual(scihub.download(self._product()), path)
+        self.assertEqual(os.listdir(data_dir), ['S1A_TEST.zip'])
+        os.remove(path)
+        self.assertEqual(scihub.download([self._product()]),
+                         [(path, hashlib.md5(self.PAYLOAD).hexdigest())])
+
+    def test_verify_earlier_download(self):
+        config.CONFIG['GENERAL']['DATA_DIR'] = self.tmp_dir
+        config.CONFIG['GENERAL']['VERIFY_ZIP'] = False
+        config.CONFIG['GENERAL']['JOURNAL'] = True
+        with open(self.destination, 'wb') as f:
+            f.write(self.PAYLOAD)
+        jrnl = journal.open_journal()
+        jrnl.update('S1A_TEST', journal.DOWNLOADED, path=self.destination)
+        path = os.path.join(self.tmp_dir, 'S1A_TEST.zip')
+        #
+        # Assert that a transfer that was completed before an interruption
+        # is verified without downloading it again.
+        #
+        self.assertEqual(scihub.download(self._product()), path)
+        self.assertEqual(self.ranges, [])
+        self.assertEqual(jrnl.is_verified('S1A_TEST', path),
+                         hashlib.md5(self.PAYLOAD).hexdigest())
+
+    def test_checksum_server_unavailable(self):
+        config.CONFIG['GENERAL']['DATA_DIR'] = self.tmp_dir
+        config.CONFIG['GENERAL']['VERIFY_ZIP'] = False
+        calls = []
+        md5 = scihub._md5
+
+        async def _md5(product, *args, **kwargs):
+            calls.append(product['filename'])
+            if len(calls) == 1:
+                raise scihub.ServerUnavailableError('LOCAL is unavailable')
+            return await md5(product, *args, **kwargs)
+
+        scihub._md5 = _md5
+        try:
+            result = scihub.download(self._product())
+        finally:
+            scihub._md5 = md5
+        #
+        # Assert that the checksum is looked up again once the server is
+        # available, instead of failing the download.
+        #
+        self.assertEqual(result, os.path.join(self.tmp_dir, 'S1A_TEST.zip'))
+        self.assertEqual(len(calls), 2)
+
+    def test_download_complete_transfer(self):
+        with open(self.destination, 'wb') as f:
+            f.write(self.PAYLOAD)
+        scihub._write_progress(self.destination, len(self.PAYLOAD))
+        result = scihub.block(scihub._download, self.url, self.destination,
+                              return_md5=True)
+        #
+        # Assert that a completed transfer is recognized from the response
+        # to the Range request (HTTP 416) instead of starting over.
+        #
+        self._assert_complete(result)
+        self.assertEqual(self.ranges,
+                         ['bytes={}-'.format(len(self.PAYLOAD))])
+
+    def test_download_segmented(self):
+        config.CONFIG['GENERAL']['SEGMENTS'] = 4
+        config.CONFIG['GENERAL']['SEGMENT_SIZE'] = 0.1
+        result = scihub.block(scihub._download, self.url, self.destination,
+                              return_md5=True)
+        self._assert_complete(result)
+        #
+        # Assert that the remote size is requested first, that the file has
+        # its final size while the segments are received, and that the
+        # segments cover the whole file.
+        #
+        size = len(self.PAYLOAD)
+        self.assertEqual(self.ranges[0], 'bytes=0-0')
+        self.assertEqual(self.sizes, [size] * 4)
+        bounds = [size * i // 4 for i in range(5)]
+        self.assertEqual(sorted(self.ranges[1:]), sorted(
+            'bytes={}-{}'.format(bounds[i], bounds[i + 1] - 1)
+            for i in range(4)))
+
+    def test_download_segmented_failure(self):
+        config.CONFIG['GENERAL']['SEGMENT_SIZE'] = 0.1
+        self.fail_at = len(self.PAYLOAD) // 4
+
+        async def _download():
+            result = await scihub._download_segmented(
+                self.url, self.destination, return_md5=True, segments=4)
+            pending = [task for task in asyncio.all_tasks()
+                       if not task.done() and task.get_coro().__name__ in
+                       ('_download_segment', '_run')]
+            return result, pending
+
+        result, pending = scihub.block(_download)
+        #
+        # Assert that the other segments have stopped before the
+        # incomplete file is removed.
+        #
+        self.assertEqual(result, (False, None))
+        self.assertEqual(pending, [])
+        self.assertFalse(os.path.exists(self.destination))
+        self.assertFalse(os.path.exists(
+            self.destination + scihub.PROGRESS_SUFFIX))
+
+    def test_download_resume(self):
+        offset = 300000
+        with open(self.destination, 'wb') as f:
+            # Bytes after the saved progress must be discarded.
+            f.write(self.PAYLOAD[:offset] + b'corrupt')
+        scihub._write_progress(self.destination, offset)
+        result = scihub.block(scihub._download, self.url, self.destination,
+                              return_md5=True)
+        #
+        # Assert that only the missing part is requested, and that the
+        # checksum includes the partial file.
+        #
+        self._assert_complete(result)
+        self.assertEqual(self.ranges, ['bytes={}-'.format(offset)])
+
+    def test_download_restart(self):
+        self.accept_ranges = False
+        with open(self.destination, 'wb') as f:
+            f.write(self.PAYLOAD[:1000])
+        result = scihub.block(scihub._download, self.url, self.destination,
+                              return_md5=True)
+        #
+        # Assert that the download starts over if the server ignores the
+        # Range header.
+        #
+        self._assert_complete(result)
+        self.assertEqual(self.ranges, ['bytes=1000-', None])
+
+
 # -----------------------------------------------------------------------------
 # CHECK
 # -----------------------------------------------------------------------------
@@ -503,6 +1166,53 @@ class ChecksumTestCase(TestCase):
                     checksum.md5(f), checksum.etag(f, chunksize=2 * size_mb)
                 )
 
+    def test_md5_hash_prefix(self):
+        for f in utils.ls(config.CONFIG['GENERAL']['DATA_DIR']):
+            with self.subTest(file=f):
+                #
+                # Assert that hashing the beginning of a file in small blocks
+                # is equivalent to hashing the same bytes at once.
+                #
+                length = os.path.getsize(f) // 2
+                with open(f, 'rb') as fid:
+                    expected = hashlib.md5(fid.read(length)).hexdigest()
+                self.assertEqual(
+                    checksum.md5_hash(f, length, blocksize=1000).hexdigest(),
+                    expected
+                )
+
+    def test_verify(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'archive.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('data.txt', 'data')
+        #
+        # Assert that a valid zip archive passes and a truncated one fails.
+        #
+        self.assertEqual(checksum.verify(path, check_zip=True),
+                         (checksum.md5(path), True))
+        with open(path, 'r+b') as f:
+            f.truncate(10)
+        self.assertEqual(checksum.verify(path, compute_md5=False,
+                                         check_zip=True), (None, False))
+
+    def test_etag_incremental(self):
+        data = os.urandom(2 * 1024**2 + 5)
+        path = os.path.join(tempfile.mkdtemp(), 'data')
+        with open(path, 'wb') as f:
+            f.write(data)
+        for system in ('swift', 'wos'):
+            with self.subTest(system=system):
+                hash_etag = checksum.ETag(1, system=system)
+                for i in range(0, len(data), 300000):
+                    hash_etag.update(data[i:i + 300000])
+                #
+                # Assert that hashing a stream in arbitrary pieces yields the
+                # etag of the file.
+                #
+                self.assertEqual(hash_etag.hexdigest(),
+                                 checksum.etag(path, 1, system=system))
+
     # def test_etag_large_files(self):
     #     pass
 
@@ -610,6 +1320,382 @@ class MainTestCase(TestCase):
                 self.assertTrue(healthy)
 
 
+# -----------------------------------------------------------------------------
+# JOURNAL
+# -----------------------------------------------------------------------------
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = journal.Journal(
+            os.path.join(self.tmp_dir, journal.JOURNAL_FILE))
+
+    def tearDown(self):
+        self.journal.close()
+
+    def test_states(self):
+        products = [{'filename': 'A', 'size': 1}, {'filename': 'B', 'size': 2}]
+        self.journal.queue(products)
+        self.assertEqual(self.journal.pending(), products)
+
+        path = os.path.join(self.tmp_dir, 'A.zip')
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        self.journal.update('A', journal.VERIFIED, md5='abc', path=path)
+        self.journal.update('B', journal.PARTIAL, offset=1)
+        #
+        # Assert that verified products are neither pending nor requeued,
+        # and that a verified file is recognized until it changes.
+        #
+        self.journal.queue(products)
+        self.assertEqual(self.journal.pending(), products[1:])
+        self.assertEqual(self.journal.get('B')['offset'], 1)
+        self.assertEqual(self.journal.is_verified('A', path), 'abc')
+        with open(path, 'ab') as f:
+            f.write(b'more data')
+        self.assertIsNone(self.journal.is_verified('A', path))
+
+    def test_runs(self):
+        self.journal.queue([{'filename': 'A'}, {'filename': 'B'}])
+        self.journal.update('B', journal.FAILED)
+        later = journal.Journal(self.journal.path)
+        try:
+            later.queue([{'filename': 'C'}])
+            #
+            # Assert that only the products of the last run are pending.
+            #
+            self.assertEqual(later.pending(), [{'filename': 'C'}])
+        finally:
+            later.close()
+
+    def test_resume_without_journal(self):
+        general = config.CONFIG['GENERAL'].copy()
+        config.CONFIG['GENERAL']['RESUME'] = True
+        config.CONFIG['GENERAL']['JOURNAL'] = False
+        try:
+            with self.assertRaises(ValueError):
+                main.query_file_list()
+        finally:
+            config.CONFIG['GENERAL'].clear()
+            config.CONFIG['GENERAL'].update(general)
+
+    def test_high_water_mark(self):
+        early = DT.datetime(2018, 1, 1, 12, 0, 0, 123000, tzinfo=pytz.utc)
+        late = DT.datetime(2018, 1, 2, 12, 0, 0, tzinfo=pytz.utc)
+        self.assertIsNone(self.journal.high_water_mark('daily'))
+        self.journal.advance('daily', late)
+        self.journal.advance('daily', early)
+        #
+        # Assert that the high-water mark is never lowered.
+        #
+        self.assertEqual(self.journal.high_water_mark('daily'), late)
+
+    def test_incremental_query(self):
+        general = config.CONFIG['GENERAL'].copy()
+        config.CONFIG['GENERAL']['DATA_DIR'] = self.tmp_dir
+        config.CONFIG['GENERAL']['JOURNAL'] = True
+        config.CONFIG['GENERAL']['INCREMENTAL_OVERLAP'] = 3600
+        products = [{'url': 'https://a.example.com/dhus/odata',
+                     'ingestiondate': DT.datetime(2018, 1, d,
+                                                  tzinfo=pytz.utc)}
+                    for d in (1, 2, 3, 4)]
+        results = [('A.zip', 'md5'), None, False, ('D.zip', 'md5')]
+        query = {'time': '2018'}
+        try:
+            main._advance_high_water_mark('daily', products, results)
+            main._since_high_water_mark(query, 'daily')
+        finally:
+            config.CONFIG['GENERAL'].clear()
+            config.CONFIG['GENERAL'].update(general)
+        #
+        # Assert that the next run starts at the last product before the
+        # first failure (skipped products don't count as failures), minus
+        # the overlap, keeps the end of the range and sorts the results by
+        # ingestion date.
+        #
+        self.assertEqual(
+            scihub._parse_time_parameter(query['time']),
+            ('2018-01-01T23:00:00.000Z', '2019-01-01T00:00:00.000Z'))
+        self.assertEqual(query['sort'], ('ingestiondate', 'asc'))
+
+    def test_incremental_query_limit(self):
+        general = config.CONFIG['GENERAL'].copy()
+        config.CONFIG['GENERAL']['DATA_DIR'] = self.tmp_dir
+        config.CONFIG['GENERAL']['JOURNAL'] = True
+        config.CONFIG['GENERAL']['INCREMENTAL_OVERLAP'] = 0
+        products = [{'url': 'https://{}.example.com/dhus/odata'.format(host),
+                     'ingestiondate': DT.datetime(2018, 1, d,
+                                                  tzinfo=pytz.utc)}
+                    for host, d in (('a', 1), ('b', 2), ('a', 3), ('b', 4))]
+        results = [('{}.zip'.format(i), 'md5') for i in range(4)]
+        query = {'time': '2018'}
+        try:
+            main._advance_high_water_mark('daily', products, results,
+                                          limit=4)
+            main._since_high_water_mark(query, 'daily')
+        finally:
+            config.CONFIG['GENERAL'].clear()
+            config.CONFIG['GENERAL'].update(general)
+        #
+        # Assert that the mark does not pass the last product of a server
+        # whose results were cut off by the limit.
+        #
+        self.assertEqual(scihub._parse_time_parameter(query['time'])[0],
+                         '2018-01-02T00:00:00.000Z')
+
+
+# -----------------------------------------------------------------------------
+# CACHE
+# -----------------------------------------------------------------------------
+class CacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = cache.ChecksumStore(
+            os.path.join(self.tmp_dir, 'cache.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_checksum_store(self):
+        md5 = '0123456789abcdef0123456789abcdef'
+        self.assertTrue(self.store.set('uuid-1', md5.upper(),
+                                       identifier='S1A_TEST'))
+        #
+        # Assert that checksums are found by uuid and by file name, and
+        # that invalid values are not stored.
+        #
+        self.assertEqual(self.store.get(uuid='uuid-1'), md5)
+        self.assertEqual(self.store.get(identifier='/data/S1A_TEST.zip'), md5)
+        self.assertFalse(self.store.set('uuid-2', '<html>Error</html>'))
+        self.assertIsNone(self.store.get(uuid='uuid-2'))
+
+    def test_canonical_url(self):
+        url = ('https://example.com/dhus/search?rows=100&q=a  AND   b'
+               '&start=200&orderby=ingestiondate desc')
+        other = ('HTTPS://example.com/dhus/search?orderby=ingestiondate desc'
+                 '&q=a AND b&start=0&rows=10')
+        self.assertEqual(cache.canonical_url(url), cache.canonical_url(other))
+
+    def test_query_cache(self):
+        queries = cache.QueryCache(os.path.join(self.tmp_dir, 'cache.sqlite'),
+                                   ttl=-1)
+        closed = 'https://example.com/search?q=ingestiondate:' \
+                 '[2017-01-01T00:00:00.000Z TO 2017-02-01T00:00:00.000Z]'
+        open_ended = 'https://example.com/search?q=ingestiondate:' \
+                     '[2017-01-01T00:00:00.000Z TO NOW]'
+        results = [{'filename': 'S1A_TEST', 'size': 1024}]
+        queries.set(closed, results)
+        queries.set(open_ended, results)
+        #
+        # Assert that the results of historical queries don't expire.
+        #
+        self.assertEqual(queries.get(closed + '&start=100&rows=100'), results)
+        self.assertIsNone(queries.get(open_ended))
+        #
+        # Assert that the least recently used results are evicted.
+        #
+        queries.max_size = len(pickle.dumps(
+            results, protocol=pickle.HIGHEST_PROTOCOL)) + 1
+        queries.set(closed.replace('2017', '2016'), results)
+        self.assertIsNone(queries.get(closed))
+        queries.close()
+
+
+# -----------------------------------------------------------------------------
+# S3
+# -----------------------------------------------------------------------------
+try:
+    import moto
+    MOCK_S3 = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')
+    MOTO_INSTALLED = s3.BOTO3_INSTALLED
+except ImportError:
+    MOTO_INSTALLED = False
+
+
+@unittest.skipUnless(MOTO_INSTALLED, 'requires moto and boto3')
+class S3TestCase(TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.mock = MOCK_S3()
+        self.mock.start()
+        self.client = s3.get_client()
+        self.client.create_bucket(Bucket='test')
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def _upload(self, data, key):
+        hash_md5 = hashlib.md5()
+        writer = s3.S3Writer('test', key, client=self.client, part_size=5,
+                             system='wos', hash_md5=hash_md5)
+
+        async def _stream():
+            for i in range(0, len(data), 1024**2):
+                await writer.write(data[i:i + 1024**2])
+            await writer.close()
+            return await writer.complete()
+
+        return scihub.block(_stream), hash_md5.hexdigest()
+
+    def test_multipart_upload(self):
+        data = os.urandom(11 * 1024**2)
+        etag, md5 = self._upload(data, 'large')
+        path = os.path.join(tempfile.mkdtemp(), 'large')
+        with open(path, 'wb') as f:
+            f.write(data)
+        #
+        # Assert that the object is complete and that its etag matches the
+        # etag of the local file.
+        #
+        body = self.client.get_object(Bucket='test', Key='large')['Body']
+        self.assertEqual(body.read(), data)
+        self.assertEqual(etag, checksum.etag(path, 5, system='wos'))
+        self.assertEqual(md5, hashlib.md5(data).hexdigest())
+
+    def test_single_part_upload(self):
+        data = b'small file'
+        etag, md5 = self._upload(data, 'small')
+        self.assertEqual(etag, md5)
+
+
+# -----------------------------------------------------------------------------
+# METRICS
+# -----------------------------------------------------------------------------
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.reset()
+
+    def tearDown(self):
+        metrics.REGISTRY.reset()
+
+    def test_exposition(self):
+        metrics.BYTES.inc(100, server='A')
+        metrics.BYTES.inc(50, server='A')
+        metrics.LATENCY.observe(0.3, operation='md5', server='A')
+        text = metrics.REGISTRY.expose()
+        #
+        # Assert that counters and histograms are exposed in the Prometheus
+        # text format.
+        #
+        self.assertIn('# TYPE esahub_download_bytes counter', text)
+        self.assertIn('esahub_download_bytes_total{server="A"} 150.0', text)
+        self.assertIn('esahub_request_duration_seconds_bucket'
+                      '{operation="md5",server="A",le="0.25"} 0', text)
+        self.assertIn('esahub_request_duration_seconds_bucket'
+                      '{operation="md5",server="A",le="0.5"} 1', text)
+        self.assertIn('esahub_request_duration_seconds_count'
+                      '{operation="md5",server="A"} 1', text)
+
+    def test_write_textfile(self):
+        path = os.path.join(tempfile.mkdtemp(), 'esahub.prom')
+        metrics.RETRIES.inc(server='A')
+        metrics.write_textfile(path)
+        with open(path) as f:
+            self.assertIn('esahub_retries_total{server="A"} 1.0', f.read())
+
+
+# -----------------------------------------------------------------------------
+# THROTTLE
+# -----------------------------------------------------------------------------
+class ThrottleTestCase(TestCase):
+
+    def test_parse_rate(self):
+        self.assertIsNone(throttle.parse_rate(None))
+        self.assertEqual(throttle.parse_rate('2MB'), 2 * 1024**2)
+        self.assertEqual(throttle.parse_rate(1000), 1000.0)
+        with self.assertRaises(ValueError):
+            throttle.parse_rate('2 parsecs')
+
+    def test_token_bucket(self):
+        bucket = throttle.TokenBucket(rate=1000)
+        #
+        # Assert that a burst within the allowance doesn't need to wait, and
+        # that the waiting time grows with the excess bytes.
+        #
+        self.assertLessEqual(bucket.reserve(1000), 0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=1)
+        self.assertAlmostEqual(bucket.reserve(500), 1.0, places=1)
+
+    def test_adaptive_limit(self):
+        limit = throttle.AdaptiveLimit('test', maximum=8, window=0)
+        self.assertEqual(limit.limit, 4)
+        limit.backoff()
+        self.assertEqual(limit.limit, 2)
+        #
+        # Assert that the throughput is measured per window, and that an
+        # improvement while all slots are in use increases the limit.
+        #
+        limit._saturated = True
+        limit.record(1000)
+        limit._saturated = True
+        limit.record(10**9)
+        self.assertEqual(limit.limit, 3)
+
+    def test_adaptive_limit_stall(self):
+        limit = throttle.AdaptiveLimit('test', maximum=8, window=0.05)
+
+        async def stall():
+            async with limit:
+                await asyncio.sleep(0.12)
+            return limit._monitor
+
+        monitor = scihub.block(stall)
+        #
+        # Assert that a transfer that receives no data at all halves the
+        # limit on every window, and that the timer stops with the transfer.
+        #
+        self.assertEqual(limit.limit, 1)
+        self.assertEqual(limit.throughput, 0)
+        self.assertIsNone(monitor)
+
+    def test_circuit_breaker(self):
+        breaker = throttle.CircuitBreaker('test', threshold=2, base=10)
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.failure()
+        #
+        # Assert that the breaker opens after `threshold` failures for
+        # between half and the full backoff period.
+        #
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertGreaterEqual(breaker.retry_in(), 4.9)
+        self.assertLessEqual(breaker.retry_in(), 10)
+        breaker._retry_at = 0
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        #
+        # Assert that a failed probe reopens the breaker with a longer
+        # backoff period, and that a success closes it.
+        #
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertGreaterEqual(breaker.retry_in(), 9.9)
+        breaker.success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_adaptive_limit_bound(self):
+        limit = throttle.AdaptiveLimit('test', maximum=2, adaptive=False)
+        active = []
+        max_active = []
+
+        async def task():
+            async with limit:
+                active.append(1)
+                max_active.append(len(active))
+                await asyncio.sleep(0.01)
+                active.pop()
+
+        async def run():
+            await asyncio.gather(*[task() for _ in range(6)])
+
+        scihub.block(run)
+        self.assertEqual(max(max_active), 2)
+
+
 # -----------------------------------------------------------------------------
 # utils
 # -----------------------------------------------------------------------------
@@ -646,3 +1732,18 @@ class UtilsTestCase(TestCase):
                     utils.parse_datetime(date_str),
                     date_obj
                 )
+
+    def test_extract(self):
+        tmp_dir = tempfile.mkdtemp()
+        archive = os.path.join(tmp_dir, 'S1A_TEST.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('S1A_TEST.SAFE/manifest.safe', 'manifest')
+        paths = utils.extract(archive, remove=True)
+        #
+        # Assert that the product directory has been extracted in place and
+        # that no temporary files or the archive are left behind.
+        #
+        self.assertEqual(paths, [os.path.join(tmp_dir, 'S1A_TEST.SAFE')])
+        self.assertTrue(os.path.isfile(
+            os.path.join(tmp_dir, 'S1A_TEST.SAFE', 'manifest.safe')))
+        self.assertEqual(os.listdir(tmp_dir), ['S1A_TEST.SAFE'])
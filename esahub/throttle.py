@@ -0,0 +1,380 @@
+# coding=utf-8
+""" This module contains methods to control the rate of network transfers
+    and to keep track of the health of the servers.
+"""
+import asyncio
+import time
+import random
+import logging
+from .config import CONFIG
+from . import utils
+
+logger = logging.getLogger('esahub')
+
+
+# Consumers only sleep once they are ahead of the allowed rate by at least
+# this many seconds, so that a stream is paused a few times per second
+# rather than once per chunk.
+MIN_SLEEP = 0.1
+
+
+def parse_rate(value):
+    """Parse a bandwidth limit.
+
+    Parameters
+    ----------
+    value : int, float, str or None
+        The rate in bytes per second, or a human readable string such as
+        '10MB' (interpreted per second).
+
+    Returns
+    -------
+    float or None
+        The rate in bytes per second, or None if unlimited.
+    """
+    if value is None or value == '' or value == 0:
+        return None
+    if isinstance(value, str):
+        rate = utils.h2b(value)
+        if rate is None:
+            raise ValueError("Invalid bandwidth limit: '{}'".format(value))
+        return rate
+    return float(value)
+
+
+class TokenBucket():
+    """
+    Limit the average rate of a stream of bytes.
+
+    This is implemented as a virtual scheduling token bucket: each consumed
+    byte moves the time at which the bucket is empty forward by `1/rate`
+    seconds. A consumer only has to wait if this time lies in the future by
+    more than the burst allowance.
+
+    Parameters
+    ----------
+    rate : float
+        The rate limit in bytes per second.
+    burst : float, optional
+        The number of bytes that may be consumed at once without waiting
+        (default: one second worth of `rate`).
+    """
+    def __init__(self, rate, burst=None):
+        if burst is None:
+            burst = rate
+        self.rate = rate
+        self.burst = burst
+        self._empty_at = time.monotonic()
+
+    def reserve(self, n):
+        """Consume `n` bytes and return the number of seconds to wait."""
+        now = time.monotonic()
+        self._empty_at = max(self._empty_at, now - self.burst / self.rate)
+        self._empty_at += n / self.rate
+        return self._empty_at - now - self.burst / self.rate
+
+    async def consume(self, n):
+        delay = self.reserve(n)
+        if delay >= MIN_SLEEP:
+            await asyncio.sleep(delay)
+
+
+class BandwidthLimiter():
+    """
+    Manage the global and per-server bandwidth limits.
+
+    The global limit is taken from `CONFIG['GENERAL']['BANDWIDTH']`, the
+    server limits from `CONFIG['SERVERS'][server]['bandwidth']`.
+    """
+    def __init__(self):
+        self._buckets = {}
+
+    def _get_bucket(self, key, limit):
+        if key not in self._buckets:
+            rate = parse_rate(limit)
+            self._buckets[key] = None if rate is None else TokenBucket(rate)
+        return self._buckets[key]
+
+    def reset(self):
+        """Discard all buckets, e.g. after changing the configuration."""
+        self._buckets = {}
+
+    async def consume(self, server, n):
+        """Account for `n` bytes received from `server`.
+
+        Waits if the global or the server bandwidth limit is exceeded.
+        """
+        buckets = [
+            self._get_bucket(None, CONFIG['GENERAL'].get('BANDWIDTH')),
+            self._get_bucket(server,
+                             CONFIG['SERVERS'][server].get('bandwidth'))
+        ]
+        delay = max([b.reserve(n) for b in buckets if b is not None] + [0])
+        if delay >= MIN_SLEEP:
+            await asyncio.sleep(delay)
+
+
+class AdaptiveLimit():
+    """
+    Adapt the number of concurrent connections to a server.
+
+    The limit follows an additive increase/multiplicative decrease (AIMD)
+    scheme: It is increased by one after every measurement window in which
+    the aggregate throughput improved while all slots were in use, and
+    halved when the server signals that it is busy (HTTP 503/429) or the
+    throughput collapses. While connections are active, the windows are
+    also evaluated on a timer, so that a complete stall counts as a collapse
+    even though no data arrives.
+
+    Parameters
+    ----------
+    name : str
+        The server name (used for logging).
+    maximum : int
+        The upper bound of the limit, usually the configured `downloads`.
+    adaptive : bool, optional
+        If False, the limit is fixed at `maximum` (default: True).
+    window : float, optional
+        The length of a throughput measurement window in seconds
+        (default: 10).
+    """
+    # Relative throughput gain required to increase the limit
+    GAIN = 0.05
+    # Relative throughput loss considered a collapse
+    COLLAPSE = 0.5
+
+    def __init__(self, name, maximum, adaptive=True, window=10.0):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.adaptive = adaptive
+        if adaptive:
+            self.limit = max(1, self.maximum // 2)
+        else:
+            self.limit = self.maximum
+        self.window = window
+        self._active = 0
+        self._saturated = False
+        self._waiters = []
+        self._bytes = 0
+        self._window_start = time.monotonic()
+        self._last_rate = None
+        self._monitor = None
+        self._monitor_loop = None
+        # The most recently measured throughput in bytes per second
+        self.throughput = None
+
+    def _set_limit(self, limit, reason):
+        limit = min(self.maximum, max(1, limit))
+        if limit != self.limit:
+            logger.info('{}: concurrency {} -> {} ({})'.format(
+                self.name, self.limit, limit, reason))
+            self.limit = limit
+            self._wake()
+
+    def _wake(self):
+        while self._waiters and self._active < self.limit:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                # The woken task increments `_active` itself.
+                break
+
+    async def acquire(self):
+        while self._active >= self.limit:
+            self._saturated = True
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self._active += 1
+        if self._active >= self.limit:
+            self._saturated = True
+        self._start_monitor()
+        self._wake()
+
+    def release(self):
+        self._active -= 1
+        if self._active <= 0:
+            self._stop_monitor()
+        self._wake()
+
+    def _start_monitor(self):
+        loop = asyncio.get_event_loop()
+        if self.window <= 0 or (self._monitor is not None and
+                                not self._monitor.done() and
+                                self._monitor_loop is loop):
+            return
+        # Idle time does not count towards the throughput.
+        self._bytes = 0
+        self._window_start = time.monotonic()
+        self._monitor = loop.create_task(self._watch())
+        self._monitor_loop = loop
+
+    def _stop_monitor(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+        self._monitor = None
+        self._monitor_loop = None
+
+    async def _watch(self):
+        while True:
+            remaining = self._window_start + self.window - time.monotonic()
+            await asyncio.sleep(max(0, remaining))
+            self._evaluate()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def record(self, n):
+        """Account for `n` bytes received and adapt the limit once the
+        current measurement window is over."""
+        self._bytes += n
+        self._evaluate()
+
+    def _evaluate(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window or elapsed <= 0:
+            return
+        rate = self._bytes / elapsed
+        if self.adaptive and rate == 0 and self._active > 0:
+            self._set_limit(self.limit // 2, 'no data received for '
+                            '{:.0f} seconds'.format(elapsed))
+        elif self.adaptive and self._last_rate is not None:
+            if rate < self._last_rate * self.COLLAPSE:
+                self._set_limit(self.limit // 2, 'throughput collapsed to '
+                                '{}/s'.format(utils.b2h(rate)))
+            elif rate > self._last_rate * (1 + self.GAIN) and \
+                    self._saturated:
+                self._set_limit(self.limit + 1, 'throughput improved to '
+                                '{}/s'.format(utils.b2h(rate)))
+        self._last_rate = rate
+        self.throughput = rate
+        self._bytes = 0
+        self._window_start = now
+        self._saturated = self._active >= self.limit
+
+    def backoff(self, reason='server busy'):
+        """Halve the limit, e.g. after an HTTP 503 or 429 response."""
+        if self.adaptive:
+            self._set_limit(self.limit // 2, reason)
+        # Restart the measurement after the disruption.
+        self._last_rate = None
+        self.throughput = 0
+        self._bytes = 0
+        self._window_start = time.monotonic()
+
+
+class AdaptiveLimits():
+    """
+    Manage one `AdaptiveLimit` per server, bounded by the configured
+    `downloads` of the server.
+    """
+    def __init__(self):
+        self._limits = {}
+
+    def __getitem__(self, server):
+        if server not in self._limits:
+            self._limits[server] = AdaptiveLimit(
+                server, CONFIG['SERVERS'][server]['downloads'],
+                adaptive=CONFIG['GENERAL'].get('ADAPTIVE_DOWNLOADS', True))
+        return self._limits[server]
+
+
+class CircuitBreaker():
+    """
+    Track the health of a server.
+
+    After `threshold` consecutive failures the breaker opens, and the server
+    should not be used for a backoff period that doubles with every
+    consecutive opening, starting at `base` seconds, with random jitter.
+    Once the backoff period is over, the breaker is half-open: a single
+    probe request decides whether it closes again or reopens.
+
+    Parameters
+    ----------
+    name : str
+        The server name (used for logging).
+    threshold : int, optional
+        The number of consecutive failures that open the breaker
+        (default: 5).
+    base : float, optional
+        The initial backoff period in seconds (default: 2).
+    maximum : float, optional
+        The maximum backoff period in seconds (default: 600).
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=5, base=2.0, maximum=600.0):
+        self.name = name
+        self.threshold = threshold
+        self.base = base
+        self.maximum = maximum
+        self.probing = False
+        self._failures = 0
+        self._openings = 0
+        self._retry_at = None
+
+    @property
+    def state(self):
+        if self._retry_at is None:
+            return self.CLOSED
+        elif time.monotonic() < self._retry_at:
+            return self.OPEN
+        else:
+            return self.HALF_OPEN
+
+    def retry_in(self):
+        """Return the number of seconds until the server may be probed."""
+        if self._retry_at is None:
+            return 0
+        return max(0, self._retry_at - time.monotonic())
+
+    def success(self):
+        if self._retry_at is not None:
+            logger.info('{}: circuit closed'.format(self.name))
+        self._failures = 0
+        self._openings = 0
+        self._retry_at = None
+
+    def failure(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN or \
+                (self.state == self.CLOSED and
+                 self._failures >= self.threshold):
+            delay = min(self.maximum, self.base * 2 ** self._openings)
+            # Equal jitter: wait between half and the full backoff period.
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self._openings += 1
+            self._retry_at = time.monotonic() + delay
+            logger.warning('{}: circuit open for {:.1f}s after {} failures'
+                           .format(self.name, delay, self._failures))
+
+
+class CircuitBreakers():
+    """
+    Manage one `CircuitBreaker` per server, shared by all sessions.
+
+    The backoff starts at `CONFIG['GENERAL']['RECONNECT_TIME']`.
+    """
+    def __init__(self):
+        self._breakers = {}
+
+    def __getitem__(self, server):
+        if server not in self._breakers:
+            self._breakers[server] = CircuitBreaker(
+                server,
+                threshold=CONFIG['GENERAL'].get('BREAKER_THRESHOLD', 5),
+                base=CONFIG['GENERAL']['RECONNECT_TIME'],
+                maximum=CONFIG['GENERAL'].get('BREAKER_MAX_WAIT', 600.0))
+        return self._breakers[server]
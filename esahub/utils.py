@@ -6,8 +6,9 @@ import datetime as DT
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse, parserinfo
 from dateutil.tz import tzutc
-import re
 import json
+import shutil
+import tempfile
 from distutils.spawn import find_executable
 from collections import OrderedDict
 
@@ -230,9 +231,9 @@ def h2b(hstr, suffix='B'):
     >>> h2b('3.5MB')
     3670016.0
     """
-    m = re.search('^[0-9\.]*', hstr)
-    num = float(m.group(0))
-    unit = hstr.replace(m.group(0), '').lstrip().upper()
+    number = hstr[:len(hstr) - len(hstr.lstrip('0123456789.'))]
+    num = float(number)
+    unit = hstr.replace(number, '').lstrip().upper()
     # factor = 1.0
     for prefix in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
         if unit == prefix + suffix:
@@ -422,3 +423,44 @@ def ls(directory, extensions=['.zip', '.tgz', '.nc'], subset=None, path=True):
                 else:
                     all_files.append(f)
     return all_files
+
+
+def extract(archive, directory=None, remove=False):
+    """Extract an archive.
+
+    The archive is first extracted into a temporary directory, so that
+    incomplete extractions are never mistaken for the product. Existing
+    entries of the same name are replaced.
+
+    Parameters
+    ----------
+    archive : str
+        The path of the archive (zip or tar).
+    directory : str, optional
+        The target directory (default: the directory of the archive).
+    remove : bool, optional
+        If True, delete the archive after successful extraction
+        (default: False).
+
+    Returns
+    -------
+    list of str
+        The paths of the extracted top level entries.
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(archive))
+    tmp_dir = tempfile.mkdtemp(dir=directory, prefix='.extract_')
+    try:
+        shutil.unpack_archive(archive, tmp_dir)
+        paths = []
+        for name in os.listdir(tmp_dir):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            os.replace(os.path.join(tmp_dir, name), path)
+            paths.append(path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if remove:
+        os.remove(archive)
+    return paths